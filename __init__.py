@@ -7,8 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import socket, time, re
-from threading import Thread
+import socket, re
 from Queue import Queue, Empty
 
 
@@ -16,185 +15,395 @@ from calibre import as_unicode
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.sources.base import (Source, Option, fixcase,
                                                   fixauthors)
-from calibre.ebooks.metadata.book.base import Metadata
-from calibre.utils.localization import canonicalize_lang
 
 class CaptchaError(Exception):
     pass
 
-def parse_details_page(url, log, timeout, browser):
-    from calibre.utils.cleantext import clean_ascii_chars
-    from calibre.ebooks.chardet import xml_to_unicode
-    import html5lib
-    from lxml.html import tostring
+def open_page(url, timeout, browser):
+    '''
+    Return the raw bytes of url, served from the on-disk page cache when
+    possible.
+    '''
+    if getattr(browser, 'offline', False):
+        # Replayed pages are neither cached nor rate limited
+        return browser.open_novisit(url, timeout=timeout).read()
+    from calibre_plugins.DANGDANG.cache import get_http_cache
+    from calibre_plugins.DANGDANG.ratelimit import rate_limited
+    from calibre_plugins.DANGDANG import replay
+    raw = get_http_cache().fetch(rate_limited(browser), url, timeout)
+    if replay.active_recorder is not None:
+        replay.active_recorder.add(url, raw)
+    return raw
+
+def captcha_detected(url):
+    '''
+    Slow down requests to the host of url and make sure the captcha page is
+    not served from the page cache.
+    '''
+    from calibre_plugins.DANGDANG.cache import get_http_cache
+    from calibre_plugins.DANGDANG.ratelimit import get_rate_limiter
+    from calibre_plugins.DANGDANG import timing
+    timing.incr('captchas')
+    get_rate_limiter().failure(url)
+    get_http_cache().invalidate(url)
+
+def fetch_details_page(url, log, timeout, browser, stream=False):
+    '''
+    Download the details page at url. Returns the raw bytes, or (raw, root,
+    complete) as returned by streaming.read_details if stream is True. Errors
+    are logged and None returned.
+    '''
+    from calibre_plugins.DANGDANG import streaming, timing
     try:
-        raw = browser.open_novisit(url, timeout=timeout).read().decode('gb18030').strip()
+        with timing.span('fetch_details'):
+            if stream:
+                return streaming.read_details(url, timeout, browser)
+            return open_page(url, timeout, browser)
     except Exception as e:
         if callable(getattr(e, 'getcode', None)) and \
                         e.getcode() == 404:
+            timing.incr('not_found')
             log.error('URL malformed: %r'%url)
             return
         attr = getattr(e, 'args', [None])
         attr = attr if attr else [None]
         if isinstance(attr[0], socket.timeout):
+            timing.incr('timeouts')
             msg = 'Amazon timed out. Try again later.'
             log.error(msg)
         else:
             msg = 'Failed to make details query: %r'%url
             log.exception(msg)
+
+def parse_details_page(url, log, timeout, browser):
+    from calibre_plugins.DANGDANG import streaming, timing
+    stream = streaming.enabled and not getattr(browser, 'offline', False)
+    ans = fetch_details_page(url, log, timeout, browser, stream)
+    if ans is None:
+        return
+    if not stream:
+        return parse_details_raw(ans, url, log)
+    raw, root, complete = ans
+    if '<title>404 - ' in raw:
+        timing.incr('not_found')
+        log.error('URL malformed: %r'%url)
+        return
+    if not complete:
+        # Not a regular details page, the whole page was read, parse it the
+        # normal way so that the html5lib fallback can kick in
+        from calibre_plugins.DANGDANG.parsers import parse_html, DETAILS_ANCHORS
+        try:
+            with timing.span('parse'):
+                root = parse_html(raw, DETAILS_ANCHORS)
+        except:
+            log.exception('Failed to parse amazon details page: %r'%url)
+            return
+    return check_details_page(raw, root, url, log)
+
+def parse_details_raw(raw, url, log):
+    '''
+    Decode and parse the downloaded bytes of a details page. Returns (raw,
+    root) where raw is the decoded page, or None if the page is unusable.
+    Only one decoded copy of the page is kept alive.
+    '''
+    from calibre.ebooks.chardet import xml_to_unicode
+    from calibre_plugins.DANGDANG.parsers import parse_html, DETAILS_ANCHORS
+    from calibre_plugins.DANGDANG import timing
+    try:
+        with timing.span('decode'):
+            raw = raw.decode('gb18030')
+        with timing.span('xml_to_unicode'):
+            raw = xml_to_unicode(raw, strip_encoding_pats=True,
+                                 resolve_entities=True)[0]
+    except Exception:
+        log.exception('Failed to decode details page: %r'%url)
         return
 
-    oraw = raw
-    raw = raw
-    raw = xml_to_unicode(raw, strip_encoding_pats=True, resolve_entities=True)[0]
     if '<title>404 - ' in raw:
+        timing.incr('not_found')
         log.error('URL malformed: %r'%url)
         return
 
     try:
-        root = html5lib.parse(raw, treebuilder='lxml',
-                              namespaceHTMLElements=False)
+        with timing.span('parse'):
+            root = parse_html(raw, DETAILS_ANCHORS)
     except:
         msg = 'Failed to parse amazon details page: %r'%url
         log.exception(msg)
         return
 
-    errmsg = root.xpath('//*[@id="errorMessage"]')
+    return check_details_page(raw, root, url, log)
+
+def check_details_page(raw, root, url, log):
+    from lxml.html import tostring
+    from calibre_plugins.DANGDANG import xpaths
+    errmsg = xpaths.error_message(root)
     if errmsg:
         msg = 'Failed to parse amazon details page: %r'%url
         msg += tostring(errmsg, method='text', encoding=unicode).strip()
         log.error(msg)
         return
 
-    from css_selectors import Select
-    selector = Select(root)
-    return oraw, root, selector
+    return raw, root
 
 def parse_dang_id(root, log, url):
+    from calibre_plugins.DANGDANG import xpaths
     try:
-        link = root.xpath('//link[@rel="canonical" and @href]')
+        link = xpaths.canonical_link(root) or xpaths.any_canonical_link(root)
         for l in link:
             return l.get('href').rpartition('/')[-1].split('.')[0]
     except Exception:
         log.exception('Error parsing ASIN for url: %r'%url)
 
+def dang_id_from_url(url):
+    return url.rpartition('/')[-1].partition('.')[0] or url
+
+large_pic_pat = re.compile(br'''<img\s[^>]*id\s*=\s*["']?largePic\b[^>]*>''', re.I)
+
+def parse_cover_url(raw):
+    '''
+    Return the cover URL from the raw bytes of a details page. Only the
+    largePic image tag is parsed, the rest of the page is not even decoded.
+    '''
+    m = large_pic_pat.search(raw)
+    if m is None:
+        return
+    from lxml.html import fragment_fromstring
+    img = fragment_fromstring(m.group().decode('gb18030', 'replace'))
+    for attr in ('src', 'wsrc'):
+        src = img.get(attr)
+        if src and 'blank.gif' not in src:
+            return src
+
+
+def richness(mi):
+    '''
+    The number of fields of mi that were found on the details page.
+    '''
+    return sum(1 for f in ('comments', 'series', 'tags', 'publisher', 'pubdate')
+               if not mi.is_null(f)) + bool(mi.has_cover)
 
-class Worker(Thread):  # Get details {{{
 
+def unique_isbns(results):
     '''
-    Get book details from amazons book page in a separate thread
+    Collapse the Metadata objects in results that have the same ISBN into
+    the richest of them, in the place of the first of them.
     '''
+    ans, seen = [], {}
+    for mi in results:
+        i = seen.get(mi.isbn) if mi.isbn else None
+        if i is None:
+            if mi.isbn:
+                seen[mi.isbn] = len(ans)
+            ans.append(mi)
+        elif richness(mi) > richness(ans[i]):
+            ans[i] = mi
+    return ans
+
+
+class UniqueISBNQueue(object):
+
+    '''
+    Forward the Metadata objects put on it to queue, except those with the
+    ISBN of one already forwarded, such as the same book sold by dangdang.com
+    and by a marketplace seller.
+    '''
+
+    def __init__(self, queue, log):
+        from threading import Lock
+        self.queue, self.log = queue, log
+        self.lock = Lock()
+        self.seen = {}
+
+    def put(self, mi):
+        from calibre_plugins.DANGDANG import timing
+        with self.lock:
+            if mi.isbn:
+                if mi.isbn in self.seen:
+                    timing.incr('duplicate_results')
+                    self.log('Ignoring %r, same ISBN as %r'%(
+                        mi.identifiers.get('dang'), self.seen[mi.isbn]))
+                    return
+                self.seen[mi.isbn] = mi.identifiers.get('dang')
+            self.queue.put(mi)
+
+
+lang_names = {
+    'eng': ('English', 'Englisch', 'Engels'),
+    'zhn': ('Chinese', u'简体中文'),
+}
+
+
+class Worker(object):  # Get details {{{
+
+    '''
+    Get book details from a dangdang book page. Workers are run by the shared
+    fetch pool, which supplies the browser to use.
+    '''
+
+    # Fields extracted only when requested, title, authors and the dang id
+    # are always extracted
+    optional_fields = frozenset(('comments', 'series', 'tags', 'cover', 'isbn',
+                                 'publisher', 'pubdate'))
+
+    # Static tables, shared by all workers
+    publisher_names = frozenset(('Publisher', '出版社'))
+    language_names = frozenset(('Language', '语种'))
+    lang_map = dict((name, code) for code, names in lang_names.iteritems()
+                    for name in names)
+
+    series_pat = re.compile(
+        r'''
+        \|\s*              # Prefix
+        (Series)\s*:\s*    # Series declaration
+        (?P<series>.+?)\s+  # The series name
+        \((Book)\s*    # Book declaration
+        (?P<index>[0-9.]+) # Series index
+        \s*\)
+        ''', re.X)
+    series_index_pat = re.compile(r'\s+([0-9.]+)$')
+    ebook_index_pat = re.compile(r'Book\s+([0-9.]+)')
 
     def __init__(self, url, result_queue, browser, log, relevance,
-                 plugin, timeout=20, testing=False, preparsed_root=None):
-        Thread.__init__(self)
+                 plugin, timeout=20, testing=False, preparsed_root=None,
+                 fields=None, backend='desktop', required=frozenset(),
+                 expected_isbn=None):
         self.preparsed_root = preparsed_root
-        self.daemon = True
+        self.backend, self.required = backend, required
+        self.expected_isbn = expected_isbn
+        self.fields = self.optional_fields if fields is None or testing else fields
         self.testing = testing
         self.url, self.result_queue = url, result_queue
         self.log, self.timeout = log, timeout
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
+        self.browser = browser
         self.cover_url = self.dang_id = self.isbn = None
         from lxml.html import tostring
-        self.tostring = tostring
-
-        self.english_months = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-        self.months = {
-            1: [u'1月'],
-            2: [u'2月'],
-            3: [u'3月'],
-            4: [u'4月'],
-            5: [u'5月'],
-            6: [u'6月'],
-            7: [u'7月'],
-            8: [u'8月'],
-            9: [u'9月'],
-            10: [u'10月'],
-            11: [u'11月'],
-            12: [u'12月'],
-        }
-
-        # Base info block
-        self.pd_desc_xpath = '//div[@id="detail_describe"]'
-        self.pd_info_xpath = 'descendant::*[@class="messbox_info"]' # dangdang store
-        self.pd_info_store_xpath = 'descendant::*[@class="book_messbox"]' # thirty store
-
-        self.publisher_xpath = '//span[@dd_name="出版社"]/a'
-        self.publisher_names = {'Publisher', '出版社'}
-
-        self.publish_date_xpath = 'descendant::*[@dd_name="出版社"]/../span[starts-with(text(), "出版时间")]'
-
-        self.language_names = {'Language', '语种'}
-
-        self.tags_xpath = '//div[@class="breadcrumb"]/a'
-
-        lm = {
-            'eng': ('English', 'Englisch', 'Engels'),
-            'zhn': ('Chinese', u'简体中文'),
-        }
-        self.lang_map = {}
-        for code, names in lm.iteritems():
-            for name in names:
-                self.lang_map[name] = code
-
-        self.series_pat = re.compile(
-            r'''
-            \|\s*              # Prefix
-            (Series)\s*:\s*    # Series declaration
-            (?P<series>.+?)\s+  # The series name
-            \((Book)\s*    # Book declaration
-            (?P<index>[0-9.]+) # Series index
-            \s*\)
-            ''', re.X)
+        from calibre_plugins.DANGDANG import xpaths
+        self.tostring, self.xpaths = tostring, xpaths
 
     def delocalize_datestr(self, raw):
-        if not self.months:
-            return raw
-        ans = raw.lower()
-        for i, vals in self.months.iteritems():
-            for x in vals:
-                ans = ans.replace(x, self.english_months[i])
-        ans = ans.replace(' de ', ' ')
-        return ans
+        from calibre_plugins.DANGDANG.normalize import delocalize_datestr
+        return delocalize_datestr(raw)
 
-    def run(self):
+    def run(self, browser=None):
+        if browser is not None:
+            self.browser = browser
         try:
             self.get_details()
         except:
             self.log.exception('get_details failed for url: %r'%self.url)
 
     def get_details(self):
+        if self.backend == 'mobile' and self.preparsed_root is None:
+            if self.get_mobile_details():
+                return
+        parse_pool = self.plugin.parse_pool() if self.preparsed_root is None else None
 
-        if self.preparsed_root is None:
-            raw, root, selector = parse_details_page(self.url, self.log, self.timeout, self.browser)
-        else:
-            raw, root, selector = self.preparsed_root
+        for attempt in xrange(2):
+            if parse_pool is not None:
+                raw = root = None
+            elif self.preparsed_root is None:
+                raw, root = parse_details_page(self.url, self.log, self.timeout, self.browser)
+            else:
+                raw, root = self.preparsed_root
+                self.preparsed_root = None
 
-        from css_selectors import Select
-        self.selector = Select(root)
-        self.parse_details(raw, root)
+            try:
+                if parse_pool is not None:
+                    self.parse_in_process(parse_pool)
+                else:
+                    self.parse_details(raw, root)
+                return
+            except CaptchaError:
+                captcha_detected(self.url)
+                if attempt:
+                    raise
+                # The rate limiter now holds back requests to this host
+                self.log.warning('Got a CAPTCHA page for %r, retrying after backing off'%self.url)
+
+    def get_mobile_details(self):
+        '''
+        Get the details from the mobile product page. Returns False if they
+        could not be found there, or the page lacks one of the required
+        fields, the desktop page should then be used.
+        '''
+        from calibre_plugins.DANGDANG import mobile, timing
+        dang_id = dang_id_from_url(self.url)
+        url = mobile.mobile_url(dang_id)
+        try:
+            with timing.span('fetch_mobile'):
+                raw = open_page(url, self.timeout, self.browser)
+            with timing.span('extract_mobile'):
+                record = mobile.parse_record(raw, dang_id, self.fields, self.required)
+        except Exception as e:
+            self.log.warning('Failed to get mobile page: %r: %s'%(url, as_unicode(e)))
+            record = None
+        if record is None:
+            timing.incr('mobile_fallbacks')
+            self.log('Using the desktop page for: %r'%self.url)
+            return False
+        self.build_metadata(record)
+        return True
 
     def parse_details(self, raw, root):
+        record = self.extract_fields(raw, root)
+        if record is not None:
+            self.build_metadata(record)
+
+    def parse_in_process(self, parse_pool):
+        '''
+        Download the details page and have it parsed by parse_pool. If the
+        parse process fails, the page is parsed in this thread instead.
+        '''
+        raw = fetch_details_page(self.url, self.log, self.timeout, self.browser)
+        if raw is None:
+            return
+        try:
+            record = parse_pool.extract(raw, self.url, self.fields, self.log, self.testing)
+        except CaptchaError:
+            raise
+        except Exception:
+            self.log.exception('Parse process failed for url: %r, parsing in this thread'%self.url)
+            ans = parse_details_raw(raw, self.url, self.log)
+            if ans is None:
+                return
+            record = self.extract_fields(*ans)
+        if record is not None:
+            self.build_metadata(record)
+
+    def extract_fields(self, raw, root):
+        '''
+        Run the field extractors over a parsed details page. Returns a
+        picklable dict with the title, authors, dang_id and the extracted
+        optional fields, or None if the page is not usable. Does not use the
+        plugin, so that it can run in a parse process.
+        '''
+        from calibre_plugins.DANGDANG.timing import span
         dang_id = parse_dang_id(root, self.log, self.url)
-        if not dang_id and root.xpath('//form[@action="/errors/validateCaptcha"]'):
+        if not dang_id and self.xpaths.captcha_form(root):
             raise CaptchaError('Amazon returned a CAPTCHA page, probably because you downloaded too many books. Wait for some time and try again.')
         if self.testing:
             import tempfile, uuid
             with tempfile.NamedTemporaryFile(prefix=(dang_id or str(uuid.uuid4()))+ '_',
                                              suffix='.html', delete=False) as f:
-                f.write(raw)
+                f.write(raw.encode('utf-8'))
             print ('Downloaded html for', dang_id, 'saved in', f.name)
 
         try:
-            title = self.parse_title(root)
+            with span('extract_title'):
+                title = self.parse_title(root)
         except:
             self.log.exception('Error parsing title for url: %r'%self.url)
             title = None
 
+        # Base info block
+        pd_info = self.xpaths.pd_info(root)
+        pd_info_store = self.xpaths.pd_info_store(root)
+
         try:
-            authors = self.parse_authors(root)
+            with span('extract_authors'):
+                authors = self.parse_authors(root, pd_info, pd_info_store)
         except:
             self.log.exception('Error parsing authors for url: %r'%self.url)
             authors = []
@@ -205,68 +414,96 @@ class Worker(Thread):  # Get details {{{
                                                              authors))
             return
 
-        mi = Metadata(title, authors)
-        idtype = 'dang'
-        mi.set_identifier(idtype, dang_id)
-        self.dang_id = dang_id
+        record = {'title': title, 'authors': authors, 'dang_id': dang_id}
 
-        try:
-            mi.comments = self.parse_comments(root, raw)
-        except:
-            self.log.exception('Error parsing comments for url: %r'%self.url)
-
-        try:
-            series, series_index = self.parse_series(root)
-            if series:
-                mi.series, mi.series_index = series, series_index
-            elif self.testing:
-                mi.series, mi.series_index = 'Dummy series for testing', 1
-        except:
-            self.log.exception('Error parsing series for url: %r'%self.url)
-
-        try:
-            mi.tags = self.parse_tags(root)
-        except:
-            self.log.exception('Error parsing tags for url: %r'%self.url)
+        fields = self.fields
+        if 'comments' in fields:
+            try:
+                with span('extract_comments'):
+                    record['comments'] = self.parse_comments(root, raw)
+            except:
+                self.log.exception('Error parsing comments for url: %r'%self.url)
 
-        try:
-            self.cover_url = self.parse_cover(root, raw)
-        except:
-            self.log.exception('Error parsing cover for url: %r'%self.url)
-        mi.has_cover = bool(self.cover_url)
+        if 'series' in fields:
+            try:
+                with span('extract_series'):
+                    series, series_index = self.parse_series(root)
+                if series:
+                    record['series'], record['series_index'] = series, series_index
+                elif self.testing:
+                    record['series'], record['series_index'] = 'Dummy series for testing', 1
+            except:
+                self.log.exception('Error parsing series for url: %r'%self.url)
 
-        pd = root.xpath(self.pd_desc_xpath)
-        pd_info = root.xpath(self.pd_info_xpath)
-        pd_info_store = root.xpath(self.pd_info_store_xpath)
-        pd_desc = root.xpath(self.pd_desc_xpath)
+        if 'tags' in fields:
+            try:
+                with span('extract_tags'):
+                    record['tags'] = self.parse_tags(root)
+            except:
+                self.log.exception('Error parsing tags for url: %r'%self.url)
 
-        if pd_info or pd_info_store:
+        if 'cover' in fields:
+            record['cover_url'] = None
             try:
-                isbn = self.parse_isbn(pd_info, pd_info_store, pd_desc)
-                if isbn:
-                    self.isbn = mi.isbn = isbn
+                with span('extract_cover'):
+                    record['cover_url'] = self.parse_cover(root, raw)
             except:
-                self.log.exception('Error parsing ISBN for url: %r'%self.url)
+                self.log.exception('Error parsing cover for url: %r'%self.url)
+
+        if not (pd_info or pd_info_store):
+            self.log.warning('Failed to find product description for url: %r'%self.url)
+        else:
+            if 'isbn' in fields:
+                pd_desc = self.xpaths.pd_desc(root)
+                try:
+                    with span('extract_isbn'):
+                        isbn = self.parse_isbn(pd_info, pd_info_store, pd_desc)
+                    if isbn:
+                        record['isbn'] = isbn
+                except:
+                    self.log.exception('Error parsing ISBN for url: %r'%self.url)
 
             if pd_info:
                 pd_info = pd_info[0]
             else:
                 pd_info = pd_info_store[0]
 
+            if 'publisher' in fields:
+                try:
+                    with span('extract_publisher'):
+                        record['publisher'] = self.parse_publisher(pd_info)
+                except:
+                    self.log.exception('Error parsing publisher for url: %r'%self.url)
 
-            try:
-                mi.publisher = self.parse_publisher(pd_info)
-            except:
-                self.log.exception('Error parsing publisher for url: %r'%self.url)
-
-            try:
-                mi.pubdate = self.parse_pubdate(pd_info)
-            except:
-                self.log.exception('Error parsing publish date for url: %r'%self.url)
+            if 'pubdate' in fields:
+                try:
+                    with span('extract_pubdate'):
+                        record['pubdate'] = self.parse_pubdate(pd_info)
+                except:
+                    self.log.exception('Error parsing publish date for url: %r'%self.url)
 
+        return record
 
-        else:
-            self.log.warning('Failed to find product description for url: %r'%self.url)
+    def build_metadata(self, record):
+        '''
+        Turn a record returned by :meth:`extract_fields` into a Metadata
+        object, update the identifier caches and put it on the result queue,
+        unless the book does not have the expected ISBN.
+        '''
+        from calibre.ebooks.metadata.book.base import Metadata
+        from calibre_plugins.DANGDANG.candidates import isbn_matches
+        from calibre_plugins.DANGDANG.timing import span
+        mi = Metadata(record['title'], record['authors'])
+        mi.set_identifier('dang', record['dang_id'])
+        self.dang_id = record['dang_id']
+        for field in ('comments', 'series', 'series_index', 'tags', 'publisher', 'pubdate'):
+            if field in record:
+                setattr(mi, field, record[field])
+        if 'cover_url' in record:
+            self.cover_url = record['cover_url']
+            mi.has_cover = bool(self.cover_url)
+        if record.get('isbn'):
+            self.isbn = mi.isbn = record['isbn']
 
         mi.source_relevance = self.relevance
 
@@ -276,8 +513,15 @@ class Worker(Thread):  # Get details {{{
             if self.cover_url:
                 self.plugin.cache_identifier_to_cover_url(self.dang_id,
                                                           self.cover_url)
+            self.plugin.add_to_index(mi)
+
+        if not isbn_matches(self.expected_isbn, self.isbn):
+            self.log('Ignoring %r, its ISBN %s is not the one searched for: %s'%(
+                self.url, self.isbn, self.expected_isbn))
+            return
 
-        self.plugin.clean_downloaded_metadata(mi)
+        with span('clean_metadata'):
+            self.plugin.clean_downloaded_metadata(mi)
 
         self.result_queue.put(mi)
 
@@ -285,13 +529,13 @@ class Worker(Thread):  # Get details {{{
         return self.tostring(elem, encoding=unicode, method='text').strip()
 
     def parse_title(self, root):
-        h1 = root.xpath('//div[@class="name_info"]/h1')
+        h1 = self.xpaths.title(root)
         if h1:
             h1 = h1[0]
             # for child in h1.xpath('./*[contains(@class, "icon_name")]'):
             #     h1.remove(child)
             return self.totext(h1)
-        tdiv = root.xpath('//img[@id="largePic"]')[0]
+        tdiv = self.xpaths.large_pic(root)[0]
         actual_title = tdiv.get('alt')
         if actual_title:
             title = actual_title.strip()
@@ -300,27 +544,38 @@ class Worker(Thread):  # Get details {{{
 
         return title
 
-    def parse_authors(self, root):
-        matches = root.xpath('//span[@id="author"]/a')
+    def parse_authors(self, root, pd_info=None, pd_info_store=None):
+        matches = None
+        if pd_info:
+            matches = self.xpaths.info_authors(pd_info[0])
+        if not matches:
+            matches = self.xpaths.authors(root)
         if matches:
             authors = [self.totext(x) for x in matches]
             return [a for a in authors if a]
 
-        matches = root.xpath('//div[@class="book_messbox"]/div[1]/div[2]')
+        if pd_info_store is None:
+            pd_info_store = self.xpaths.pd_info_store(root)
+        matches = [m for store in pd_info_store if store.tag == 'div'
+                   for m in self.xpaths.store_authors(store)]
         if matches:
             authors = [self.totext(x) for x in matches]
             return [a for a in authors if a]
 
     def _render_comments(self, desc):
         from calibre.library.comments import sanitize_comments_html
-        import html5lib
+        from calibre_plugins.DANGDANG.normalize import clean_comments
+        # Encoding bug in Amazon data U+fffd (replacement char)
+        # in some examples it is present in place of ', tag attributes,
+        # extra whitespace and HTML comments are removed in the same pass
+        return sanitize_comments_html(clean_comments(self._comments_text(desc)))
+
+    def _comments_text(self, desc):
+        from calibre_plugins.DANGDANG.parsers import parse_fragment
         # html5lib parsed noscript as CDATA
 
-        desc = html5lib.parseFragment('<div>%s</div>' % (self.totext(desc).replace('textarea', 'div')), \
-                                      treebuilder='lxml', namespaceHTMLElements=False)[0]
-        matches = desc.xpath('descendant::*[contains(text(), "内容提要") \
-            or contains(text(), "内容推荐") or contains(text(), "编辑推荐") \
-            or contains(text(), "内容简介") or contains(text(), "基本信息")]/../*[self::p or self::div or self::span]')
+        desc = parse_fragment(self.totext(desc).replace('textarea', 'div'))
+        matches = self.xpaths.comments_sections(desc)
 
         if matches:
             if len(matches)>1:
@@ -331,91 +586,75 @@ class Worker(Thread):  # Get details {{{
                         desc = item
                         break
 
-        for c in desc.xpath('descendant::noscript'):
+        for c in self.xpaths.noscript(desc):
             c.getparent().remove(c)
-        for c in desc.xpath('descendant::*[@class="seeAll" or'
-                            ' @class="emptyClear" or @id="collapsePS" or'
-                            ' @id="expandPS"]'):
+        for c in self.xpaths.comments_junk(desc):
             c.getparent().remove(c)
         #
-        for a in desc.xpath('descendant::a[@href]'):
+        for a in self.xpaths.links(desc):
             del a.attrib['href']
             a.tag = 'span'
-        desc = self.tostring(desc, method='text', encoding=unicode).strip()
-        # return desc
-        # Encoding bug in Amazon data U+fffd (replacement char)
-        # in some examples it is present in place of '
-        desc = desc.replace('\ufffd', "'")
-        # remove all attributes from tags
-        desc = re.sub(r'<([a-zA-Z0-9]+)\s[^>]+>', r'<\1>', desc)
-        # Collapse whitespace
-        desc = re.sub('\n+', '\n', desc)
-        desc = re.sub(' +', ' ', desc)
-        # Remove the notice about text referring to out of print editions
-        desc = re.sub(r'(?s)<em>--This text ref.*?</em>', '', desc)
-        # Remove comments
-        desc = re.sub(r'(?s)<!--.*?-->', '', desc)
-        return sanitize_comments_html(desc)
+        return self.tostring(desc, method='text', encoding=unicode).strip()
 
     def parse_comments(self, root, raw):
-        from urllib import unquote
         ans = ''
-        ns = root.xpath('//div[@class="descrip"]')
+        ns = self.xpaths.comments(root)
 
         if ns:
             ns = ns[0]
             if len(ns) == 0 and ns.text:
-                import html5lib
+                from calibre_plugins.DANGDANG.parsers import parse_fragment
                 # html5lib parsed noscript as CDATA
-                ns = html5lib.parseFragment('<div>%s</div>' % (ns.text), treebuilder='lxml', namespaceHTMLElements=False)[0]
+                ns = parse_fragment(ns.text)
 
-            ans = self._render_comments(ns)
+            from calibre_plugins.DANGDANG.timing import span
+            with span('render_comments'):
+                ans = self._render_comments(ns)
 
         return ans
 
     def parse_series(self, root):
+        from calibre_plugins.DANGDANG.normalize import clean_series, collapse_whitespace
         ans = (None, None)
 
         # This is found on the paperback/hardback pages for books on amazon.com
-        series = root.xpath('//div[@data-feature-name="seriesTitle"]')
+        series = self.xpaths.series_title(root)
         if series:
             series = series[0]
-            spans = series.xpath('./span')
+            spans = self.xpaths.series_spans(series)
             if spans:
                 raw = self.tostring(spans[0], encoding=unicode, method='text', with_tail=False).strip()
-                m = re.search('\s+([0-9.]+)$', raw.strip())
+                m = self.series_index_pat.search(raw.strip())
                 if m is not None:
                     series_index = float(m.group(1))
-                    s = series.xpath('./a[@id="series-page-link"]')
+                    s = self.xpaths.series_link(series)
                     if s:
                         series = self.tostring(s[0], encoding=unicode, method='text', with_tail=False).strip()
                         if series:
                             ans = (series, series_index)
         # This is found on Kindle edition pages on amazon.com
         if ans == (None, None):
-            for span in root.xpath('//div[@id="aboutEbooksSection"]//li/span'):
+            for span in self.xpaths.series_ebook_spans(root):
                 text = (span.text or '').strip()
-                m = re.match('Book\s+([0-9.]+)', text)
+                m = self.ebook_index_pat.match(text)
                 if m is not None:
                     series_index = float(m.group(1))
-                    a = span.xpath('./a[@href]')
+                    a = self.xpaths.span_links(span)
                     if a:
                         series = self.tostring(a[0], encoding=unicode, method='text', with_tail=False).strip()
                         if series:
                             ans = (series, series_index)
         if ans == (None, None):
-            desc = root.xpath('//div[@id="ps-content"]/div[@class="buying"]')
+            desc = self.xpaths.series_buying(root)
             if desc:
-                raw = self.tostring(desc[0], method='text', encoding=unicode)
-                raw = re.sub(r'\s+', ' ', raw)
+                raw = collapse_whitespace(self.tostring(desc[0], method='text', encoding=unicode))
                 match = self.series_pat.search(raw)
                 if match is not None:
                     s, i = match.group('series'), float(match.group('index'))
                     if s:
                         ans = (s, i)
         if ans[0]:
-            ans = (re.sub(r'\s+Series$', '', ans[0]).strip(), ans[1])
-            ans = (re.sub(r'\(.+?\s+Series\)$', '', ans[0]).strip(), ans[1])
+            ans = (clean_series(ans[0]), ans[1])
         return ans
 
     def parse_tags(self, root):
@@ -424,7 +663,7 @@ class Worker(Thread):  # Get details {{{
         exclude = {'special features', 'by authors', 'authors & illustrators', 'books', 'new; used & rental textbooks'}
         seen = set()
 
-        for a in root.xpath(self.tags_xpath):
+        for a in self.xpaths.tags(root):
             raw = (a.text or '').strip().replace(',', ';').replace('/', ';').replace('>', ';')
 
             lraw = icu_lower(raw)
@@ -436,7 +675,7 @@ class Worker(Thread):  # Get details {{{
         return ans
 
     def parse_cover(self, root, raw=b""):
-        matches = root.xpath('//img[@id="largePic"]')
+        matches = self.xpaths.large_pic(root)
         if matches:
             src = matches[0].get('src')
             if 'blank.gif' not in src:
@@ -447,6 +686,7 @@ class Worker(Thread):  # Get details {{{
                 return src
 
     def parse_new_details(self, root, mi, non_hero):
+        from calibre.utils.localization import canonicalize_lang
         table = non_hero.xpath('descendant::table')[0]
         for tr in table.xpath('descendant::tr'):
             cells = tr.xpath('descendant::td')
@@ -478,12 +718,8 @@ class Worker(Thread):  # Get details {{{
                         self.isbn = mi.isbn = ans
 
     def parse_isbn(self, pd, pd_info, pd_desc):
-        pd_xpath = 'descendant::div[@class="show_info_left" and (contains(text(), "I") and \
-                contains(text(), "S") and contains(text(), "B") and contains(text(), "N")) or (\
-                contains(text(), "Ｉ") and contains(text(), "Ｓ") and contains(text(), "Ｂ") and \
-                contains(text(), "Ｎ"))]/../div'
         if pd:
-            matches = pd[0].xpath(pd_xpath)
+            matches = self.xpaths.info_isbn_cells(pd[0])
 
             if matches:
                 ans = check_isbn(self.totext(matches[1]).strip())
@@ -494,7 +730,7 @@ class Worker(Thread):  # Get details {{{
 
 
         if pd_info:
-            matches = pd_info[0].xpath(pd_xpath)
+            matches = self.xpaths.info_isbn_cells(pd_info[0])
             if matches:
                 ans = check_isbn(self.totext(matches[1]).strip())
                 if ans:
@@ -503,9 +739,10 @@ class Worker(Thread):  # Get details {{{
                     self.log.info('wrong isbn: %s'%self.totext(matches[1]).strip())
 
         if pd_desc:
-            matches = pd_desc[0].xpath('descendant::*[starts-with(text(), "国际标准书号ISBN")]')
+            matches = self.xpaths.desc_isbn(pd_desc[0])
             if matches:
-                matches = re.split(r'(:|：|\n)+', self.totext(matches[0]))
+                from calibre_plugins.DANGDANG.normalize import split_isbn_label
+                matches = split_isbn_label(self.totext(matches[0]))
                 if len(matches)>1:
                     ans = check_isbn(matches[-1].strip())
                     if ans:
@@ -514,42 +751,36 @@ class Worker(Thread):  # Get details {{{
                         self.log.info('wrong isbn: %s'%self.totext(matches[-1].strip()))
 
     def parse_publisher(self, pd):
-        matches = pd.xpath(self.publisher_xpath)
+        matches = self.xpaths.info_publisher(pd) or self.xpaths.any_publisher(pd)
 
         if matches:
             return self.totext(matches[0])
 
-        matches = pd.xpath('descendant::div[@class="show_info_left" and contains(text(), "出") and \
-        contains(text(), "版") and contains(text(), "社")]/../div')
+        matches = self.xpaths.info_publisher_cells(pd)
 
         if matches:
             return self.totext(matches[1])
 
 
     def parse_pubdate(self, pd):
-        matches = pd.xpath(self.publish_date_xpath)
+        matches = self.xpaths.info_pubdate(pd)
         date = None
         if matches:
             date = self.totext(matches[0])
 
         if not matches:
-            matches = pd.xpath('//div[@class="show_info_left" and contains(text(), "出版时间")]/../div')
+            matches = self.xpaths.info_pubdate_cells(pd) or self.xpaths.any_pubdate_cells(pd)
 
             if len(matches)>1:
                 date = self.totext(matches[1])
 
         if date:
             from calibre.utils.date import parse_only_date
-
-            date = date.replace('年', '/').replace('月', '/').replace('日', '') \
-                .replace('-', '/').replace('出版时间', '').replace(':', '').strip()
-            if date.endswith('/'):
-                date = "%s1"%date
-
-            date = self.delocalize_datestr(date)
-            return parse_only_date(date, assume_utc=True)
+            from calibre_plugins.DANGDANG.normalize import pubdate_text
+            return parse_only_date(pubdate_text(date), assume_utc=True)
 
     def parse_language(self, pd):
+        from calibre.utils.localization import canonicalize_lang
         for x in reversed(pd.xpath(self.language_xpath)):
             if x.tail:
                 raw = x.tail.strip().partition(',')[0].strip()
@@ -573,10 +804,80 @@ class Dang(Source):
     has_html_comments = True
     supports_gzip_transfer_encoding = True
     prefer_results_with_isbn = False
-    auto_trim_covers = True
+    # Covers are trimmed by cover_data, using the cached trimmed version
+    # when there is one
+    auto_trim_covers = False
+
+    options = (
+        Option('cache_ttl', 'number', 168, _('Page cache lifetime (hours):'),
+               _('Downloaded dangdang.com pages younger than this are reused'
+                 ' without contacting the server. Older pages are revalidated.')),
+        Option('cache_size', 'number', 200, _('Page cache size (MB):'),
+               _('Maximum disk space used by cached dangdang.com pages. The'
+                 ' least recently used pages are removed first.')),
+        Option('pool_size', 'number', 4, _('Simultaneous downloads:'),
+               _('Number of dangdang.com pages downloaded in parallel, shared'
+                 ' by all metadata and cover downloads.')),
+        Option('fetch_backend', 'choices', 'browser', _('Download engine:'),
+               _('The standard engine uses calibre\'s browser. The persistent'
+                 ' connections engine keeps connections to dangdang.com open'
+                 ' and shares them between the search and details pages.'),
+               choices={'browser':_('Standard'),
+                        'keepalive':_('Persistent connections')}),
+        Option('max_rate', 'number', 4, _('Maximum requests per second:'),
+               _('Upper limit on the request rate to each dangdang.com host.'
+                 ' The rate is lowered automatically when dangdang.com'
+                 ' returns CAPTCHA pages, server errors or times out.')),
+        Option('html_parser', 'choices', 'auto', _('HTML parser:'),
+               _('Automatic uses the fastest available parser and falls back'
+                 ' to html5lib for pages it cannot handle.'),
+               choices={'auto':_('Automatic'), 'lxml':'lxml',
+                        'html5-parser':'html5-parser', 'html5lib':'html5lib'}),
+        Option('streaming', 'bool', False, _('Stop downloading pages early'),
+               _('Parse details pages while they download and stop as soon as'
+                 ' all the information used by this plugin has been read.')),
+        Option('cover_cache_size', 'number', 100, _('Cover cache size (MB):'),
+               _('Maximum disk space used by downloaded covers. The least'
+                 ' recently used covers are removed first.')),
+        Option('negative_ttl', 'number', 24, _('Remember failed searches (hours):'),
+               _('Searches that found nothing on dangdang.com are not repeated'
+                 ' for this long. Set to zero to always search again.')),
+        Option('hedged_search', 'bool', True, _('Search by ISBN and title at once'),
+               _('When both the ISBN and the title and authors are known, run'
+                 ' both searches at the same time and use the first one that'
+                 ' finds the book, instead of searching by title only after'
+                 ' the ISBN search has failed. Faster for books dangdang.com'
+                 ' does not know the ISBN of, at the cost of more requests.')),
+        Option('identify_mode', 'choices', 'full', _('Metadata download:'),
+               _('Fast mode only downloads the search results page and gets'
+                 ' the title, authors, publisher and publication date from it.'
+                 ' Tags, comments, series and ISBN are not downloaded. In the'
+                 ' background variant the book pages are downloaded afterwards'
+                 ' so that later downloads and covers are faster and better.'),
+               choices={'full':_('Full'), 'fast':_('Fast'),
+                        'fast_enrich':_('Fast, complete in the background')}),
+        Option('parse_processes', 'number', 0, _('Parse processes:'),
+               _('Number of separate processes used to parse downloaded book'
+                 ' pages, so that parsing uses several CPU cores. Zero parses'
+                 ' pages in the download threads. The processes take a moment'
+                 ' to start, so this only helps when downloading metadata for'
+                 ' many books. Pages are always downloaded in full when enabled.')),
+        Option('details_backend', 'choices', 'desktop', _('Book pages:'),
+               _('The mobile book pages are much smaller and quicker to'
+                 ' process than the desktop ones, but do not have tags,'
+                 ' series or publisher. The desktop page is used for books'
+                 ' whose mobile page cannot be used.'),
+               choices={'desktop':_('Desktop'), 'mobile':_('Mobile')}),
+        Option('local_index', 'bool', True, _('Look up known books locally'),
+               _('Keep an index of the books already downloaded, and look'
+                 ' books up in it before searching dangdang.com. The search is'
+                 ' skipped when the title and authors, or the ISBN, match a'
+                 ' known book.')),
+    )
 
     def __init__(self, *args, **kwargs):
         Source.__init__(self, *args, **kwargs)
+        self.search_cover_urls = {}
         self.set_dang_id_touched_fields()
 
     def test_fields(self, mi):
@@ -607,6 +908,185 @@ class Dang(Source):
         x.startswith('identifier:dang')] + [ident_name]
         self.touched_fields = frozenset(tf)
 
+    def fetch_pool(self):
+        from calibre_plugins.DANGDANG.pool import get_fetch_pool
+        return get_fetch_pool(self.browser, self.prefs['pool_size'])
+
+    def parse_pool(self):
+        from calibre_plugins.DANGDANG.parsepool import get_parse_pool
+        return get_parse_pool(self.prefs['parse_processes'])
+
+    def fetch_browser(self, browser=None):
+        '''
+        Return the browser used to download pages, according to the selected
+        download engine. browser is the default engine browser to use.
+        '''
+        if self.prefs['fetch_backend'] == 'keepalive':
+            from calibre_plugins.DANGDANG.connections import get_keepalive_browser
+            return get_keepalive_browser(self.user_agent)
+        return self.browser if browser is None else browser
+
+    def extraction_fields(self, fields=None):
+        '''
+        Return the optional fields Workers should extract: those of fields
+        (by default all of them) that are in touched_fields and not ignored
+        in the metadata download preferences, calibre would throw them away.
+        The ISBN and cover URL are extracted unless fields excludes them, as
+        they feed the identifier caches used to download covers.
+        '''
+        try:
+            from calibre.ebooks.metadata.sources.prefs import msprefs
+            ignored = frozenset(msprefs['ignore_fields'])
+        except Exception:
+            ignored = frozenset()
+        if fields is None:
+            fields = Worker.optional_fields
+        return frozenset(f for f in fields if f in ('isbn', 'cover') or
+                         (f in self.touched_fields and f not in ignored))
+
+    def mobile_required_fields(self, fields=None):
+        '''
+        Return the fields a mobile page must have for Workers to use it
+        instead of the desktop page: the ISBN if fields asks for it. By
+        default the ISBN is only extracted for the identifier caches, it is
+        not one of touched_fields, so mobile pages without it are used.
+        '''
+        if fields is not None and 'isbn' in fields:
+            return frozenset(('isbn',))
+        return frozenset()
+
+    def run_workers(self, workers, abort):
+        '''
+        Run workers on the shared fetch pool and wait until they have all
+        finished or abort is set.
+        '''
+        self.run_jobs([w.run for w in workers], abort)
+
+    def run_jobs(self, jobs, abort):
+        '''
+        Run jobs, callables taking the browser to use, on the shared fetch
+        pool and wait until they have all finished or abort is set.
+        '''
+        from calibre_plugins.DANGDANG.timing import bind
+        pool, done = self.fetch_pool(), Queue()
+
+        def wrap(job):
+            def run(browser):
+                if not abort.is_set():
+                    job(self.fetch_browser(browser))
+            return bind(run)
+
+        for job in jobs:
+            pool.submit(wrap(job), done)
+        pending = len(jobs)
+        while pending and not abort.is_set():
+            try:
+                done.get(timeout=0.2)
+            except Empty:
+                continue
+            pending -= 1
+
+    def apply_settings(self):
+        '''
+        Apply the plugin settings to the process wide page cache, rate
+        limiter and parser.
+        '''
+        from calibre_plugins.DANGDANG.cache import get_http_cache
+        from calibre_plugins.DANGDANG.ratelimit import get_rate_limiter
+        from calibre_plugins.DANGDANG.parsers import set_default_backend
+        from calibre_plugins.DANGDANG import streaming
+        get_rate_limiter().set_max_rate(max(0.2, self.prefs['max_rate']))
+        set_default_backend(self.prefs['html_parser'])
+        streaming.set_enabled(self.prefs['streaming'])
+        from calibre_plugins.DANGDANG.covers import get_cover_cache
+        get_cover_cache(max_size=self.prefs['cover_cache_size'] * 1024 * 1024)
+        return get_http_cache(ttl=self.prefs['cache_ttl'] * 3600,
+                              max_size=self.prefs['cache_size'] * 1024 * 1024)
+
+    def cache_isbn_to_identifier(self, isbn, identifier):
+        from calibre_plugins.DANGDANG.cache import get_identifier_store
+        Source.cache_isbn_to_identifier(self, isbn, identifier)
+        get_identifier_store().set_isbn_to_identifier(isbn, identifier)
+
+    def cached_isbn_to_identifier(self, isbn):
+        ans = Source.cached_isbn_to_identifier(self, isbn)
+        if ans is None:
+            from calibre_plugins.DANGDANG.cache import get_identifier_store
+            ans = get_identifier_store().isbn_to_identifier(isbn)
+            if ans is not None:
+                Source.cache_isbn_to_identifier(self, isbn, ans)
+        return ans
+
+    def cache_identifier_to_cover_url(self, id_, url):
+        from calibre_plugins.DANGDANG.cache import get_identifier_store
+        Source.cache_identifier_to_cover_url(self, id_, url)
+        get_identifier_store().set_identifier_to_cover_url(id_, url)
+
+    def cached_identifier_to_cover_url(self, id_):
+        ans = Source.cached_identifier_to_cover_url(self, id_)
+        if ans is None:
+            from calibre_plugins.DANGDANG.cache import get_identifier_store
+            ans = get_identifier_store().identifier_to_cover_url(id_)
+            if ans is not None:
+                Source.cache_identifier_to_cover_url(self, id_, ans)
+        return ans
+
+    def index_tokens(self, title, authors, only_first_author=False):
+        ans = set()
+        if title:
+            ans.update('t:' + icu_lower(t) for t in self.get_title_tokens(title))
+        if authors:
+            ans.update('a:' + icu_lower(t) for t in self.get_author_tokens(
+                authors, only_first_author=only_first_author))
+        return ans
+
+    def add_to_index(self, mi):
+        '''
+        Add the book mi, parsed from its details page, to the local index.
+        The ISBN and publisher already indexed are kept when mi lacks them,
+        for example because the Worker was restricted to other fields.
+        '''
+        if not self.prefs['local_index']:
+            return
+        from calibre_plugins.DANGDANG.index import get_product_index
+        get_product_index().add(mi.identifiers['dang'], mi.title, mi.authors,
+                                mi.isbn or None, mi.publisher or None,
+                                self.index_tokens(mi.title, mi.authors))
+
+    def local_candidates(self, log, title=None, authors=None, identifiers={}):
+        '''
+        Return the books in the local index matching the query as Candidate
+        records, most recently indexed first: the books with the ISBN if
+        there is one, otherwise those with exactly the title tokens and
+        first author tokens of the query. A book whose title only contains
+        the query title, such as a later volume, is not a match. Returns []
+        if there is no match.
+        '''
+        if not self.prefs['local_index']:
+            return []
+        from calibre_plugins.DANGDANG.candidates import Candidate, dedupe, MAX_CANDIDATES
+        from calibre_plugins.DANGDANG.index import get_product_index
+        from calibre_plugins.DANGDANG import timing
+        isbn = check_isbn(identifiers.get('isbn', None))
+        if not isbn and not (title and authors):
+            return []
+        index = get_product_index()
+        with timing.span('local_index'):
+            if isbn:
+                rows = index.lookup_isbn(isbn)
+            else:
+                tokens = self.index_tokens(title, authors, only_first_author=True)
+                rows = [r for r in index.lookup(tokens) if self.index_tokens(
+                    r[1], r[2], only_first_author=True) == tokens]
+            matches = dedupe([Candidate('http://product.dangdang.com/%s.html'%dang_id, i, t, a,
+                                        publisher, None, None, None, x)
+                              for i, (dang_id, t, a, x, publisher) in enumerate(rows)])
+            matches = matches[:MAX_CANDIDATES]
+        if matches:
+            timing.incr('local_index_hits')
+            log('Found %d known books in the local index, not searching'%len(matches))
+        return matches
+
     def get_dang_id(self, identifiers):
         for key, val in identifiers.iteritems():
             key = key.lower()
@@ -632,12 +1112,14 @@ class Dang(Source):
     # }}}
 
     def clean_downloaded_metadata(self, mi):
+        from calibre_plugins.DANGDANG.normalize import (title_series_pat,
+                                                         strip_series_from_title)
         docase = (
             mi.language == 'zhn'
         )
         if mi.title and docase:
             # Remove series information from title
-            m = re.search(r'\S+\s+(\(.+?\s+Book\s+\d+\))$', mi.title)
+            m = title_series_pat.search(mi.title)
             if m is not None:
                 mi.title = mi.title.replace(m.group(1), '').strip()
             mi.title = fixcase(mi.title)
@@ -648,12 +1130,7 @@ class Dang(Source):
         if mi.series and docase:
             mi.series = fixcase(mi.series)
         if mi.title and mi.series:
-            for pat in (r':\s*Book\s+\d+\s+of\s+%s$', r'\(%s\)$', r':\s*%s\s+Book\s+\d+$'):
-                pat = pat % re.escape(mi.series)
-                q = re.sub(pat, '', mi.title, flags=re.I).strip()
-                if q and q != mi.title:
-                    mi.title = q
-                    break
+            mi.title = strip_series_from_title(mi.title, mi.series)
 
     def create_query(self, log, title=None, authors=None, identifiers={}):  # {{{
         from urllib import urlencode
@@ -689,7 +1166,7 @@ class Dang(Source):
         if not ('key1' in q or 'key2' in q or
                     ('key4' in q)):
             # Insufficient metadata to make an identify query
-            return None, None
+            return None
 
         encode_to='gb18030'
         encoded_q = dict([(x.encode(encode_to, 'ignore'), y.encode(encode_to,
@@ -715,51 +1192,49 @@ class Dang(Source):
         return url
     # }}}
 
-    def parse_results_page(self, root):  # {{{
-        from lxml.html import tostring
-
-        matches = []
+    def parse_results_page(self, root, title=None, authors=None,  # {{{
+                           isbn=None):
+        '''
+        Return the URLs of the details pages worth looking at, best first.
+        '''
+        return [c.url for c in self.parse_candidates(root, title, authors, isbn)]
 
-        def title_ok(title):
-            title = title.lower()
-            bad = ['bulk pack', '[audiobook]', '[audio cd]', '(a book companion)', '( slipcase with door )', ': free sampler']
-            for x in bad:
-                if x in title:
-                    return False
-            # if title and title[0] in '[{' and re.search(r'\(\s*author\s*\)', title) is not None:
-            #     # Bad entries in the catalog
-            #     return False
-            return True
-
-        for a in root.xpath(r'//li[starts-with(@class, "line")]//a[@href and contains(@name, "itemlist-picture")]'):
-            # title = a.get('title')
-            # if title_ok(title):
-            url = a.get('href')
-            if url.startswith('/'):
-                url = 'http://product.dangdang.com/%s' % (url)
-            matches.append(url)
-
-        # Keep only the top 5 matches as the matches are sorted by relevance by
-        # Amazon so lower matches are not likely to be very relevant
-        return matches[:5]
+    def parse_candidates(self, root, title=None, authors=None, isbn=None):
+        '''
+        Return the results on the search results page worth looking at, as
+        Candidate records, best first. The results are ranked against title
+        and authors using what the results page shows of each book, so that
+        details pages are only downloaded for plausible matches. isbn is the
+        ISBN searched for, if the page is the result of an ISBN search.
+        '''
+        from calibre_plugins.DANGDANG.candidates import parse_candidates, rank
+        title_tokens = list(self.get_title_tokens(title)) if title else []
+        author_tokens = list(self.get_author_tokens(
+            authors, only_first_author=True)) if authors else []
+        return rank(parse_candidates(root), title_tokens, author_tokens, isbn=isbn)
     # }}}
 
     def fetch_raw(self, log, url, br, testing,  # {{{
                   identifiers={}, timeout=30):
         from calibre.utils.cleantext import clean_ascii_chars
         from calibre.ebooks.chardet import xml_to_unicode
-        from lxml.html import tostring
-        import html5lib
+        from calibre_plugins.DANGDANG.parsers import parse_html, SEARCH_ANCHORS
+        from calibre_plugins.DANGDANG import timing
         try:
-            raw = br.open_novisit(url, timeout=timeout).read().decode('gb18030').strip()
+            with timing.span('fetch_search'):
+                raw = open_page(url, timeout, br)
+            with timing.span('decode'):
+                raw = raw.decode('gb18030').strip()
         except Exception as e:
             if callable(getattr(e, 'getcode', None)) and \
                             e.getcode() == 404:
+                timing.incr('not_found')
                 log.error('Query malformed: %r'%url)
                 return
             attr = getattr(e, 'args', [None])
             attr = attr if attr else [None]
             if isinstance(attr[0], socket.timeout):
+                timing.incr('timeouts')
                 msg = _('DangDang timed out. Try again later.')
                 log.error(msg)
             else:
@@ -767,8 +1242,9 @@ class Dang(Source):
                 log.exception(msg)
             return as_unicode(msg)
 
-        raw = clean_ascii_chars(xml_to_unicode(raw,
-                                               strip_encoding_pats=True, resolve_entities=True)[0])
+        with timing.span('xml_to_unicode'):
+            raw = clean_ascii_chars(xml_to_unicode(raw,
+                                                   strip_encoding_pats=True, resolve_entities=True)[0])
 
         if testing:
             import tempfile
@@ -777,13 +1253,13 @@ class Dang(Source):
                 f.write(raw.encode('utf-8'))
             print ('Downloaded html for results page saved in', f.name)
 
-        matches = []
+        root = None
         found = '<title>对不起，您要访问的页面暂时没有找到' not in raw
 
         if found:
             try:
-                root = html5lib.parse(raw, treebuilder='lxml',
-                                      namespaceHTMLElements=False)
+                with timing.span('parse'):
+                    root = parse_html(raw, SEARCH_ANCHORS)
             except:
                 msg = 'Failed to parse DangDang page for query: %r'%url
                 log.exception(msg)
@@ -791,123 +1267,538 @@ class Dang(Source):
 
         return found, root
 
+    def find_matches(self, log, abort, br, title=None, authors=None,
+                     identifiers={}, timeout=30, testing=False):
+        '''
+        Return the URLs of the details pages matching the query. Retries
+        without identifiers if nothing is found with them.
+        '''
+        return [c.url for c in self.find_candidates(
+            log, abort, br, title=title, authors=authors, identifiers=identifiers,
+            timeout=timeout, testing=testing)]
+
+    def find_candidates(self, log, abort, br, title=None, authors=None,
+                        identifiers={}, timeout=30, testing=False):
+        '''
+        Like :meth:`find_matches` but return Candidate records. When the
+        query is a dang id, the only candidate has just its URL set.
+        '''
+        from calibre_plugins.DANGDANG.candidates import Candidate
+        query = self.create_query(log, title=title, authors=authors,
+                                  identifiers=identifiers)
+        if query is None:
+            log.error('Insufficient metadata to construct query')
+            return []
+        if testing:
+            print ('Using user agent for dangdang: %s'%self.user_agent)
+
+        matches = []
+        if query.startswith('http://product.'):
+            matches = [Candidate(query, 0, None, None, None, None, None, None, None)]
+        else:
+            matches = self.local_candidates(log, title=title, authors=authors,
+                                            identifiers=identifiers)
+            if matches:
+                return matches
+            isbn = check_isbn(identifiers.get('isbn', None))
+            if isbn and title and authors and self.prefs['hedged_search']:
+                return self.hedged_search(log, abort, br, query, isbn, title, authors,
+                                          timeout=timeout, testing=testing)
+            matches = self.search_candidates(
+                log, abort, br, query, 'isbn' if isbn else 'title_authors',
+                title=title, authors=authors, isbn=isbn,
+                timeout=timeout, testing=testing)
+
+        if abort.is_set():
+            return []
+
+        if not matches:
+            if identifiers and title and authors:
+                log('No matches found with identifiers, retrying using only'
+                    ' title and authors. Query: %r'%query)
+                return self.find_candidates(log, abort, br, title=title,
+                                            authors=authors, timeout=timeout,
+                                            testing=testing)
+            log.error('No matches found with query: %r'%query)
+        return matches
+
+    def hedged_search(self, log, abort, br, isbn_query, isbn, title, authors,
+                      timeout=30, testing=False):
+        '''
+        Run the ISBN search and the title and authors search at the same
+        time on the shared fetch pool, instead of falling back to the latter
+        only once the former has found nothing. Results of the ISBN search
+        are used as soon as there are any, those of the title search as soon
+        as the ISBN search has found nothing or, if it comes back first, its
+        best result matches the whole query. The other search is then
+        cancelled through its abort event if it has not been sent yet, or
+        its results ignored.
+
+        A search that no pool thread has picked up after a short wait is run
+        in the calling thread, which may itself be a pool thread, as for
+        identify_many, so that searches waiting on each other cannot fill
+        the pool.
+        '''
+        from threading import Event, Lock
+        from calibre_plugins.DANGDANG.candidates import confident
+        from calibre_plugins.DANGDANG.timing import bind
+        title_query = self.create_query(log, title=title, authors=authors)
+        cancelled, done = Event(), Queue()
+        lock, started = Lock(), set()
+
+        def search(stage, query):
+            def run(browser):
+                with lock:
+                    if stage in started:
+                        return
+                    started.add(stage)
+                matches = []
+                try:
+                    if not abort.is_set() and not cancelled.is_set():
+                        matches = self.search_candidates(
+                            log, abort, browser, query, stage, title=title,
+                            authors=authors, isbn=isbn if stage == 'isbn' else None,
+                            timeout=timeout, testing=testing)
+                except Exception:
+                    log.exception('Search failed: %r'%query)
+                done.put((stage, matches))
+            return run
+
+        searches = [(stage, search(stage, query)) for stage, query in (
+            ('isbn', isbn_query), ('title_authors', title_query))]
+        pool = self.fetch_pool()
+        for stage, run in searches:
+            pool.submit(bind(lambda browser, run=run: run(self.fetch_browser(browser))))
+
+        results = {}
+        while len(results) < 2 and not abort.is_set():
+            try:
+                stage, matches = done.get(timeout=0.2)
+            except Empty:
+                pending = [run for stage, run in searches if stage not in started]
+                if pending:
+                    pending[0](br)
+                continue
+            results[stage] = matches
+            by_isbn, by_title = results.get('isbn'), results.get('title_authors')
+            if by_isbn:
+                winner = 'isbn'
+            elif by_title and (by_isbn is not None or confident(by_title)):
+                winner = 'title_authors'
+            else:
+                continue
+            cancelled.set()
+            log('Using the results of the %s search'%winner)
+            return results[winner]
+        cancelled.set()
+        if not abort.is_set():
+            log.error('No matches found with queries: %r and %r'%(isbn_query, title_query))
+        return []
+
+    def search_candidates(self, log, abort, br, query, stage, title=None,
+                          authors=None, isbn=None, timeout=30, testing=False):
+        '''
+        Run the search query and return the ranked candidates. Queries that
+        found nothing are remembered for negative_ttl hours, along with the
+        fallback stage they were made at, and not repeated in that time.
+        Their result pages are not kept in the page cache, so that the query
+        really is repeated afterwards. isbn is the ISBN searched for, if
+        query is an ISBN search.
+        '''
+        from calibre_plugins.DANGDANG.cache import get_identifier_store, get_http_cache
+        from calibre_plugins.DANGDANG import timing, xpaths
+        ttl = self.prefs['negative_ttl'] * 3600
+        store = get_identifier_store()
+        if ttl > 0:
+            missed = store.missed_query(query, ttl)
+            if missed is not None:
+                timing.incr('negative_cache_hits')
+                log('Not repeating %s search that found nothing (%s) %.1f hours'
+                    ' ago: %r'%(missed[0], missed[1], missed[2] / 3600, query))
+                return []
+
+        ans = self.fetch_raw(log, query, br, testing, timeout=timeout)
+        if not isinstance(ans, tuple):
+            # Network or parse errors are not remembered
+            get_http_cache().invalidate(query)
+            return []
+        found, root = ans
+        if found and xpaths.captcha_form(root):
+            log.warning('Got a CAPTCHA page for search: %r'%query)
+            captcha_detected(query)
+            return []
+        matches = self.parse_candidates(root, title=title, authors=authors,
+                                        isbn=isbn) if found else []
+        if not matches:
+            get_http_cache().invalidate(query)
+            if ttl > 0 and not abort.is_set():
+                store.set_missed_query(query, stage, 'no_results' if found else 'not_found')
+        return matches
+
     def identify(self, log, result_queue, abort, title=None, authors=None,  # {{{
                  identifiers={}, timeout=30):
         '''
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
-        '''
-        from calibre.utils.cleantext import clean_ascii_chars
-        from calibre.ebooks.chardet import xml_to_unicode
-        from lxml.html import tostring
-        import html5lib
 
+        The time spent in each stage and the number of cache hits, captcha
+        pages, etc. are logged at the end as a JSON summary, also available
+        as last_identify_stats.
+        '''
+        from calibre_plugins.DANGDANG import timing
+        with timing.collecting() as stats:
+            try:
+                with timing.span('identify'):
+                    return self._identify(log, result_queue, abort, title=title,
+                                          authors=authors, identifiers=identifiers,
+                                          timeout=timeout)
+            finally:
+                self.last_identify_stats = stats.summary()
+                log.debug('Identify timings:', stats.to_json())
+
+    def _identify(self, log, result_queue, abort, title=None, authors=None,
+                  identifiers={}, timeout=30):
         testing = getattr(self, 'running_a_test', False)
-        br = self.browser
+        br = self.fetch_browser()
+        self.apply_settings()
+        fields = self.extraction_fields()
+        backend = self.prefs['details_backend']
 
         udata = self._get_book_url(identifiers)
         if udata is not None:
             # Try to directly get details page instead of running a search
             dang_id, durl = udata
+            if backend == 'mobile':
+                w = Worker(durl, result_queue, br, log, 0, self, testing=testing,
+                           fields=fields, backend=backend)
+                if w.get_mobile_details():
+                    return
             preparsed_root = parse_details_page(durl, log, timeout, br)
             if preparsed_root is not None:
                 qdang_id = parse_dang_id(preparsed_root[1], log, durl)
                 if qdang_id == dang_id:
-                    w = Worker(durl, result_queue, br, log, 0, self, testing=testing, preparsed_root=preparsed_root)
+                    w = Worker(durl, result_queue, br, log, 0, self, testing=testing,
+                               preparsed_root=preparsed_root, fields=fields)
                     try:
                         w.get_details()
                         return
                     except Exception:
                         log.exception('get_details failed for url: %r'%durl)
 
-        query = self.create_query(log, title=title, authors=authors,
-                                          identifiers=identifiers)
-        if query is None:
-            log.error('Insufficient metadata to construct query')
+        matches = self.find_candidates(log, abort, br, title=title, authors=authors,
+                                       identifiers=identifiers, timeout=timeout,
+                                       testing=testing)
+        if abort.is_set() or not matches:
             return
-        if testing:
-            print ('Using user agent for dangdang: %s'%self.user_agent)
-        #####
-        if query.startswith('http://product.'):
-            found = True
-            matches = [query]
-        else:
-            found, root = self.fetch_raw(log, query, br, testing)
 
-            if found:
-                matches = self.parse_results_page(root)
+        matches = list(enumerate(matches))
+        mode = self.prefs['identify_mode']
+        if mode != 'full':
+            # Results built from the search results page, details pages are
+            # only needed for candidates missing the basic fields. Results of
+            # an ISBN search after the first may be other editions, they are
+            # checked against their details pages.
+            remaining, done = [], []
+            for i, c in matches:
+                mi = self.candidate_metadata(c, i) if i == 0 or c.isbn is None else None
+                if mi is None:
+                    remaining.append((i, c))
+                else:
+                    result_queue.put(mi)
+                    done.append(c.url)
+            if mode == 'fast_enrich':
+                self.enrich_in_background(done, log, timeout)
+            matches = remaining
+
+        result_queue = UniqueISBNQueue(result_queue, log)
+        workers = [Worker(c.url, result_queue, None, log, i, self, timeout=timeout,
+                          testing=testing, fields=fields, backend=backend,
+                          expected_isbn=c.isbn)
+                   for i, c in matches]
+        self.run_workers(workers, abort)
 
-        if abort.is_set():
-            return
+        return None
+    # }}}
 
-        if not matches:
-            if identifiers and title and authors:
-                log('No matches found with identifiers, retrying using only'
-                    ' title and authors. Query: %r'%query)
-                return self.identify(log, result_queue, abort, title=title,
-                                     authors=authors, timeout=timeout)
-            log.error('No matches found with query: %r'%query)
-            return
+    def candidate_metadata(self, candidate, relevance):
+        '''
+        Return a Metadata object with what the search results page shows of
+        candidate, or None if it does not show the title and authors.
+        '''
+        if not candidate.title or not candidate.authors:
+            return None
+        from calibre.ebooks.metadata.book.base import Metadata
+        mi = Metadata(candidate.title, candidate.authors)
+        dang_id = dang_id_from_url(candidate.url)
+        mi.set_identifier('dang', dang_id)
+        mi.publisher = candidate.publisher
+        if candidate.pubdate:
+            from calibre.utils.date import parse_only_date
+            try:
+                mi.pubdate = parse_only_date(candidate.pubdate, assume_utc=True)
+            except Exception:
+                pass
+        if candidate.cover_url:
+            mi.has_cover = True
+            # The search results only have a small version of the cover, it
+            # is kept in memory and only used by download_cover when the
+            # large one cannot be found from the details page
+            self.search_cover_urls[dang_id] = candidate.cover_url
+        mi.source_relevance = relevance
+        self.clean_downloaded_metadata(mi)
+        return mi
+
+    def enrich_in_background(self, urls, log, timeout=30):
+        '''
+        Fetch and parse the details pages at urls on the fetch pool without
+        waiting for them. The results are not returned, but the pages end
+        up in the page cache and the ISBN and large cover URL of the books
+        in the identifier caches, for later identify and cover downloads.
+        '''
+        from calibre_plugins.DANGDANG.timing import bind
+        pool = self.fetch_pool()
+        for url in urls:
+            w = Worker(url, Queue(), None, log, 0, self, timeout=timeout,
+                       fields=frozenset(('isbn', 'cover')),
+                       backend=self.prefs['details_backend'])
+            pool.submit(bind(lambda browser, w=w: w.run(self.fetch_browser(browser))))
+
+    def identify_many(self, log, abort, queries, timeout=30, fields=None,  # {{{
+                      backend=None):
+        '''
+        Identify many books at once. queries is a list of (title, authors,
+        identifiers) tuples. Yields (index, results) as soon as all the
+        candidates for the query at index have been processed, where
+        results is a list of Metadata objects.
+
+        Searches and details pages are fetched on the shared fetch pool,
+        which caps the number of simultaneous downloads. A details page
+        that is a candidate for several queries is downloaded and parsed
+        only once, and results with the same ISBN are collapsed into the
+        richest of them.
+
+        fields restricts the fields extracted from details pages, see
+        :meth:`extraction_fields`, for example to ('tags',) for a tagging
+        job. Title, authors and the dang id are always extracted. backend
+        selects the details pages used, 'desktop' or 'mobile', instead of the
+        details_backend setting. Mobile pages without the ISBN are only
+        passed over for the desktop ones when fields asks for it.
+
+        Once all queries are done the timings and counters aggregated over
+        the whole run are logged, and stored in last_identify_stats.
+        '''
+        from calibre_plugins.DANGDANG.candidates import isbn_matches
+        from calibre_plugins.DANGDANG import timing
+        testing = getattr(self, 'running_a_test', False)
+        self.apply_settings()
+        required = self.mobile_required_fields(fields)
+        fields = self.extraction_fields(fields)
+        backend = backend or self.prefs['details_backend']
+        pool, done = self.fetch_pool(), Queue()
+        stats = timing.Stats()
+
+        def resolve(i, title, authors, identifiers):
+            def run(browser):
+                matches = []
+                if not abort.is_set():
+                    try:
+                        matches = self.find_candidates(
+                            log, abort, self.fetch_browser(browser), title=title,
+                            authors=authors, identifiers=identifiers,
+                            timeout=timeout, testing=testing)
+                    except Exception:
+                        log.exception('Search failed for query: %r'%title)
+                done.put(('resolved', i, matches))
+            return timing.bind(run, stats)
+
+        def details(key, url):
+            def run(browser):
+                rq = Queue()
+                if not abort.is_set():
+                    Worker(url, rq, None, log, 0, self, timeout=timeout, testing=testing,
+                           fields=fields, backend=backend,
+                           required=required).run(self.fetch_browser(browser))
+                mis = []
+                while True:
+                    try:
+                        mis.append(rq.get_nowait())
+                    except Empty:
+                        break
+                done.put(('parsed', key, mis))
+            return timing.bind(run, stats)
+
+        for i, (title, authors, identifiers) in enumerate(queries):
+            pool.submit(resolve(i, title, authors, identifiers or {}))
+
+        candidates = {}  # query index -> [(key, relevance, expected ISBN), ...]
+        remaining = {}  # query index -> keys not yet parsed
+        waiting = {}  # key -> query indices waiting for it
+        parsed = {}  # key -> [Metadata, ...]
+        unresolved = len(queries)
+
+        def results(i):
+            ans = []
+            for key, relevance, isbn in candidates.pop(i):
+                for mi in parsed[key]:
+                    if not isbn_matches(isbn, mi.isbn):
+                        log('Ignoring %s, its ISBN %s is not the one searched for: %s'%(
+                            key, mi.isbn, isbn))
+                        continue
+                    mi = mi.deepcopy()
+                    mi.source_relevance = relevance
+                    ans.append(mi)
+            del remaining[i]
+            unique = unique_isbns(ans)
+            if len(unique) < len(ans):
+                stats.incr('duplicate_results', len(ans) - len(unique))
+                timing.totals.incr('duplicate_results', len(ans) - len(unique))
+            return unique
+
+        start = timing.monotonic()
+        while (unresolved or remaining) and not abort.is_set():
+            try:
+                event, x, val = done.get(timeout=0.2)
+            except Empty:
+                continue
+            if event == 'resolved':
+                unresolved -= 1
+                candidates[x], remaining[x] = [], set()
+                for relevance, c in enumerate(val):
+                    key = dang_id_from_url(c.url)
+                    if key in (k for k, r, isbn in candidates[x]):
+                        continue
+                    candidates[x].append((key, relevance, c.isbn))
+                    if key in parsed:
+                        continue
+                    remaining[x].add(key)
+                    if key not in waiting:
+                        waiting[key] = set()
+                        pool.submit(details(key, c.url))
+                    waiting[key].add(x)
+                if not remaining[x]:
+                    yield x, results(x)
+            else:
+                parsed[x] = val
+                for i in waiting.pop(x, ()):
+                    remaining[i].discard(x)
+                    if not remaining[i]:
+                        yield i, results(i)
+        elapsed = timing.monotonic() - start
+        stats.add_span('identify_many', elapsed)
+        timing.totals.add_span('identify_many', elapsed)
+        self.last_identify_stats = stats.summary()
+        log.debug('Identify timings for %d queries:'%len(queries), stats.to_json())
+    # }}}
 
-        workers = [Worker(url, result_queue, br, log, i, self,
-                          testing=testing) for i, url in enumerate(matches)]
-
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
-
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
-                    break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+    def resolve_cover_urls(self, log, abort, title=None, authors=None,  # {{{
+                           identifiers={}, timeout=30, limit=1):
+        '''
+        Find the cover URLs of up to limit candidate books without running
+        a full identify: only the search page (if there is no dang id) and
+        the largePic tag of the details pages are looked at. Returns
+        (dang_id, cover_url) pairs in order of relevance.
+        '''
+        br = self.fetch_browser()
+        dang_id = self.get_dang_id(identifiers)
+        if dang_id is not None:
+            matches = ['http://product.dangdang.com/%s.html'%dang_id]
+        else:
+            matches = self.find_matches(log, abort, br, title=title,
+                                        authors=authors, identifiers=identifiers,
+                                        timeout=timeout)[:limit]
+        found = {}
 
-        return None
+        def cover(relevance, url):
+            def run(browser):
+                try:
+                    cover_url = parse_cover_url(open_page(url, timeout, browser))
+                except Exception:
+                    log.exception('Failed to find cover URL in: %r'%url)
+                    return
+                if cover_url:
+                    found[relevance] = (dang_id_from_url(url), cover_url)
+                    self.cache_identifier_to_cover_url(found[relevance][0], cover_url)
+            return run
+
+        self.run_jobs([cover(i, url) for i, url in enumerate(matches)], abort)
+        return [found[i] for i in sorted(found)]
     # }}}
 
+    def cached_cover_data(self, url, dang_id):
+        '''
+        Return the trimmed image data for the cover at url, or of the book
+        dang_id, from the cover cache, or None if it is not cached.
+        '''
+        from calibre_plugins.DANGDANG.covers import get_cover_cache
+        ans = get_cover_cache().get(url, dang_id, 'trimmed')
+        if ans is not None:
+            variant, data = ans
+            if variant != 'trimmed':
+                from calibre_plugins.DANGDANG.covers import trim
+                data = trim(data) or data
+            return data
+
+    def cover_data(self, url, dang_id, browser, timeout):
+        '''
+        Return the trimmed image data for the cover at url, from the cover
+        cache if possible, otherwise downloading it and adding it to the
+        cache.
+        '''
+        ans = self.cached_cover_data(url, dang_id)
+        if ans is None:
+            from calibre_plugins.DANGDANG.covers import get_cover_cache, make_variants
+            from calibre_plugins.DANGDANG.ratelimit import rate_limited
+            data = rate_limited(browser).open_novisit(url, timeout=timeout).read()
+            variants = make_variants(data)
+            get_cover_cache().put(url, dang_id, data, variants)
+            ans = variants.get('trimmed', data)
+        return ans
+
     def download_cover(self, log, result_queue, abort,  # {{{
                        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+        self.apply_settings()
+        dang_id = self.get_dang_id(identifiers)
+        if dang_id is None and identifiers.get('isbn', None) is not None:
+            dang_id = self.cached_isbn_to_identifier(identifiers['isbn'])
         cached_url = self.get_cached_cover_url(identifiers)
-        if cached_url is None:
-            log.info('No cached cover found, running identify')
-            rq = Queue()
-            self.identify(log, rq, abort, title=title, authors=authors,
-                          identifiers=identifiers)
-            if abort.is_set():
+        if cached_url is None and dang_id is not None and not get_best_cover:
+            # A cover downloaded earlier for this book can be used even if
+            # its URL is not known any more
+            cdata = self.cached_cover_data(None, dang_id)
+            if cdata is not None:
+                log('Using cached cover for dang id:', dang_id)
+                result_queue.put((self, cdata))
                 return
-            results = []
-            while True:
-                try:
-                    results.append(rq.get_nowait())
-                except Empty:
-                    break
-            results.sort(key=self.identify_results_keygen(
-                title=title, authors=authors, identifiers=identifiers))
-            for mi in results:
-                cached_url = self.get_cached_cover_url(mi.identifiers)
-                if cached_url is not None:
-                    break
         if cached_url is None:
+            log.info('No cached cover found, looking up cover URL')
+            urls = self.resolve_cover_urls(log, abort, title=title, authors=authors,
+                                           identifiers=identifiers, timeout=timeout,
+                                           limit=3 if get_best_cover else 1)
+        else:
+            urls = [(dang_id, cached_url)]
+        if abort.is_set():
+            return
+        if not urls and dang_id in self.search_cover_urls:
+            log.info('Using the small cover from the search results')
+            urls = [(dang_id, self.search_cover_urls[dang_id])]
+        if not urls:
             log.info('No cover found')
             return
 
-        if abort.is_set():
-            return
-        br = self.browser
-        log('Downloading cover from:', cached_url)
-        try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+        def download(dang_id, url):
+            def run(browser):
+                log('Downloading cover from:', url)
+                try:
+                    result_queue.put((self, self.cover_data(url, dang_id, browser, timeout)))
+                except:
+                    log.exception('Failed to download cover from:', url)
+            return run
 
-            result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
-            # }}}
+        if len(urls) == 1:
+            download(*urls[0])(self.fetch_browser())
+        else:
+            self.run_jobs([download(*x) for x in urls], abort)
+    # }}}
 
 if __name__ == '__main__':  # tests {{{
     # To run these test use: calibre-debug src/calibre/ebooks/metadata/sources/amazon.py
@@ -0,0 +1,693 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Benchmarks for the page processing pipeline. Run with:
+
+    calibre-debug -e benchmark.py -- <command> [saved pages...]
+
+Pages are raw (gb18030) dangdang.com pages as downloaded, for example by
+the record command, which saves the pages downloaded by identify into a
+corpus directory. The replay command runs the details and search
+pipelines over such a corpus and compares the results with the golden
+output stored in it.
+'''
+
+import sys, time, gc
+
+
+def load_plugin():
+    from calibre.customize.ui import initialized_plugins
+    initialized_plugins()
+    import calibre_plugins.DANGDANG as ans
+    return ans
+
+
+def load_pages(paths):
+    ans = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            ans.append((path, f.read()))
+    return ans
+
+
+class Log(object):
+
+    def __call__(self, *args):
+        pass
+    info = warning = debug = error = exception = __call__
+
+
+def retained_size(obj):
+    '''
+    Bytes held by the Python strings in obj (a pipeline result) plus the
+    number of other Python objects it keeps alive.
+    '''
+    if isinstance(obj, (bytes, unicode)):
+        return sys.getsizeof(obj), 0
+    if isinstance(obj, (tuple, list)):
+        size = count = 0
+        for x in obj:
+            s, c = retained_size(x)
+            size, count = size + s, count + c
+        return size, count
+    return 0, 0 if obj is None else 1
+
+
+def measure(func, pages, repeat=3):
+    '''
+    Run func over the raw bytes of every page. Returns a dict with the
+    throughput and the per page cost in objects and string bytes.
+    '''
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for name, raw in pages:
+            func(raw)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    before = len(gc.get_objects())
+    results = [func(raw) for name, raw in pages]
+    objects = len(gc.get_objects()) - before
+    size = count = 0
+    for r in results:
+        s, c = retained_size(r)
+        size, count = size + s, count + c
+    n = max(1, len(pages))
+    del results
+    return {'pages_per_sec': len(pages) / best if best else 0,
+            'ms_per_page': 1000 * best / n,
+            'gc_objects_per_page': objects / n,
+            'string_bytes_per_page': size / n,
+            'extra_objects_per_page': count / n}
+
+
+def legacy_parse_details_page(raw):
+    '''
+    The details page pipeline as it was before the single parse rewrite:
+    two decoded copies of the page are kept and a css_selectors Select is
+    built twice. Kept only as a baseline for comparison.
+    '''
+    from calibre.ebooks.chardet import xml_to_unicode
+    from css_selectors import Select
+    import html5lib
+    raw = raw.decode('gb18030').strip()
+    oraw = raw
+    raw = xml_to_unicode(raw, strip_encoding_pats=True, resolve_entities=True)[0]
+    root = html5lib.parse(raw, treebuilder='lxml', namespaceHTMLElements=False)
+    selector = Select(root)
+    Select(root)
+    return oraw, raw, root, selector
+
+
+def bench_details(pages, repeat=3):
+    dd = load_plugin()
+    log = Log()
+    current = lambda raw: dd.parse_details_raw(raw, 'benchmark', log)
+    return [('before', measure(legacy_parse_details_page, pages, repeat)),
+            ('after', measure(current, pages, repeat))]
+
+
+FIELDS = ('title', 'authors', 'identifiers', 'isbn', 'publisher', 'pubdate',
+          'tags', 'series', 'series_index', 'comments')
+
+
+def bench_plugin(dd):
+    '''
+    A Dang instance that does not write to the persistent caches.
+    '''
+    class Plugin(dd.Dang):
+
+        def cache_isbn_to_identifier(self, *args):
+            pass
+
+        def cache_identifier_to_cover_url(self, *args):
+            pass
+
+        def add_to_index(self, *args):
+            pass
+
+    return Plugin(None)
+
+
+def extract(dd, plugin, raw, root, url='benchmark', fields=None):
+    '''
+    Run the Worker field extractors over a parsed details page and return
+    the extracted fields as a dict, or None if extraction failed.
+    '''
+    from Queue import Queue
+    rq = Queue()
+    w = dd.Worker(url, rq, None, Log(), 0, plugin, fields=fields)
+    w.parse_details(raw, root)
+    if rq.empty():
+        return None
+    mi = rq.get()
+    ans = dict((f, getattr(mi, f, None)) for f in FIELDS)
+    ans['cover_url'] = w.cover_url
+    return ans
+
+
+def bench_parsers(pages, repeat=3):
+    '''
+    Compare parse time of every available parser backend and check that
+    the fields extracted from their trees match those from html5lib.
+    '''
+    from calibre.ebooks.chardet import xml_to_unicode
+    from calibre_plugins.DANGDANG import parsers
+    dd = load_plugin()
+    plugin = bench_plugin(dd)
+    decoded = [(name, xml_to_unicode(raw.decode('gb18030'), strip_encoding_pats=True,
+                                     resolve_entities=True)[0]) for name, raw in pages]
+    reference = {}
+    for name, raw in decoded:
+        reference[name] = extract(dd, plugin, raw, parsers.parse_html5lib(raw))
+
+    rows = []
+    for backend in ('html5lib', 'lxml', 'html5-parser', 'auto'):
+        if backend == 'html5-parser' and not parsers._available('html5_parser'):
+            continue
+        parse = (lambda raw: parsers.parse_html(raw, parsers.DETAILS_ANCHORS, 'auto')) \
+            if backend == 'auto' else parsers.BACKENDS[backend]
+        stats = measure(parse, decoded, repeat)
+        mismatched = 0
+        for name, raw in decoded:
+            if extract(dd, plugin, raw, parse(raw)) != reference[name]:
+                mismatched += 1
+                print('%s: fields differ from html5lib for %s' % (backend, name))
+        stats['parity_mismatches'] = mismatched
+        del stats['string_bytes_per_page'], stats['extra_objects_per_page']
+        rows.append((backend, stats))
+    return rows
+
+
+def legacy_worker(dd):
+    '''
+    A Worker built the way it was before its static tables moved to class
+    level: every instance rebuilds the months and language tables and
+    compiles the series pattern. Kept only as a baseline for comparison.
+    '''
+    import re
+
+    class Worker(dd.Worker):
+
+        def __init__(self, *args, **kwargs):
+            dd.Worker.__init__(self, *args, **kwargs)
+            self.english_months = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                   'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+            self.months = dict((i, ['%d月' % i]) for i in xrange(1, 13))
+            self.publisher_names = {'Publisher', '出版社'}
+            self.language_names = {'Language', '语种'}
+            lm = {
+                'eng': ('English', 'Englisch', 'Engels'),
+                'zhn': ('Chinese', u'简体中文'),
+            }
+            self.lang_map = {}
+            for code, names in lm.iteritems():
+                for name in names:
+                    self.lang_map[name] = code
+            self.series_pat = re.compile(dd.Worker.series_pat.pattern, re.X)
+
+    return Worker
+
+
+def bench_startup(count=10000, repeat=3):
+    '''
+    Time a fresh import of the plugin package and the construction of
+    count Workers, and list the plugin modules loaded at import time, which
+    should only be the package itself.
+    '''
+    import importlib
+    from Queue import Queue
+    dd = load_plugin()
+    prefix = 'calibre_plugins.DANGDANG'
+    best, loaded = None, ()
+    for i in xrange(repeat):
+        for name in [k for k in sys.modules if k == prefix or k.startswith(prefix + '.')]:
+            del sys.modules[name]
+        before = set(sys.modules)
+        start = time.time()
+        importlib.import_module(prefix)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+        loaded = sorted(set(sys.modules) - before)
+    print('Modules loaded by importing the plugin:', ', '.join(loaded))
+    rows = [('import', {'ms': 1000 * best, 'modules_loaded': len(loaded)})]
+
+    dd = sys.modules[prefix]
+    plugin, rq, log = bench_plugin(dd), Queue(), Log()
+    for label, cls in (('worker before', legacy_worker(dd)), ('worker after', dd.Worker)):
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            for j in xrange(count):
+                cls('http://product.dangdang.com/1.html', rq, None, log, j, plugin)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rows.append((label, {'us_per_worker': 1e6 * best / count}))
+    return rows
+
+
+def legacy_clean_comments(desc):
+    import re
+    desc = desc.replace('\ufffd', "'")
+    desc = re.sub(r'<([a-zA-Z0-9]+)\s[^>]+>', r'<\1>', desc)
+    desc = re.sub('\n+', '\n', desc)
+    desc = re.sub(' +', ' ', desc)
+    desc = re.sub(r'(?s)<em>--This text ref.*?</em>', '', desc)
+    return re.sub(r'(?s)<!--.*?-->', '', desc)
+
+
+def legacy_pubdate_text(date):
+    date = date.replace('年', '/').replace('月', '/').replace('日', '') \
+        .replace('-', '/').replace('出版时间', '').replace(':', '').strip()
+    if date.endswith('/'):
+        date = "%s1"%date
+    ans = date.lower()
+    for i in xrange(1, 13):
+        ans = ans.replace('%d月' % i, legacy_pubdate_text.months[i])
+    return ans.replace(' de ', ' ')
+legacy_pubdate_text.months = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                              'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def legacy_strip_series(title, series):
+    import re
+    for pat in (r':\s*Book\s+\d+\s+of\s+%s$', r'\(%s\)$', r':\s*%s\s+Book\s+\d+$'):
+        pat = pat % re.escape(series)
+        q = re.sub(pat, '', title, flags=re.I).strip()
+        if q and q != title:
+            return q
+    return title
+
+
+def bench_normalize(pages, repeat=3, count=200):
+    '''
+    Compare the text clean up functions of the normalize module with the
+    code they replaced, over the descriptions of the given pages plus the
+    samples of tests/test_normalize.py, and check that they give the same
+    results.
+    '''
+    import os
+    from Queue import Queue
+    from calibre_plugins.DANGDANG import normalize, xpaths
+    from calibre_plugins.DANGDANG.parsers import parse_fragment
+    dd = load_plugin()
+    w = dd.Worker('benchmark', Queue(), None, Log(), 0, bench_plugin(dd))
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests'))
+    from test_normalize import COMMENTS, DATES, TITLES
+    descriptions = [raw for raw, expected in COMMENTS]
+    for name, raw in pages:
+        ans = dd.parse_details_raw(raw, name, Log())
+        ns = xpaths.comments(ans[1]) if ans is not None else None
+        if ns:
+            ns = ns[0]
+            if len(ns) == 0 and ns.text:
+                ns = parse_fragment(ns.text)
+            descriptions.append(w._comments_text(ns))
+
+    rows = []
+    for label, samples, before, after in (
+            ('comments', [(d,) for d in descriptions], legacy_clean_comments, normalize.clean_comments),
+            ('pubdate', [(raw,) for raw, expected in DATES], legacy_pubdate_text, normalize.pubdate_text),
+            ('series in title', [args for args, expected in TITLES], legacy_strip_series,
+             normalize.strip_series_from_title)):
+        stats = {'samples': len(samples)}
+        for which, func in (('before', before), ('after', after)):
+            best = None
+            for i in xrange(repeat):
+                start = time.time()
+                for j in xrange(count):
+                    for args in samples:
+                        func(*args)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            stats[which + '_us'] = 1e6 * best / (count * len(samples))
+        mismatched = 0
+        for args in samples:
+            if before(*args) != after(*args):
+                mismatched += 1
+                print('%s: results differ for %r' % (label, args))
+        stats['parity_mismatches'] = mismatched
+        rows.append((label, stats))
+    return rows
+
+
+def bench_fields(pages, repeat=3):
+    '''
+    Time the field extractors over already parsed details pages, for all
+    fields and for the subsets used by bulk jobs.
+    '''
+    dd = load_plugin()
+    plugin = bench_plugin(dd)
+    parsed = []
+    for name, raw in pages:
+        ans = dd.parse_details_raw(raw, name, Log())
+        if ans is not None:
+            parsed.append((ans[0], ans[1]))
+    rows = []
+    for label, fields in (('all fields', None), ('isbn and cover', ('isbn', 'cover')),
+                          ('tags', ('tags',)), ('title and authors', ())):
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            for raw, root in parsed:
+                extract(dd, plugin, raw, root, fields=fields)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        n = max(1, len(parsed))
+        rows.append((label, {'pages': len(parsed), 'ms_per_page': 1000 * best / n}))
+    return rows
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[int(round(p / 100 * (len(values) - 1)))]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return ans / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def jsonable(val):
+    if isinstance(val, dict):
+        return dict((k, jsonable(v)) for k, v in val.iteritems())
+    if isinstance(val, (list, tuple)):
+        return [jsonable(v) for v in val]
+    if hasattr(val, 'isoformat'):
+        return val.isoformat()
+    return val
+
+
+def run_pipeline(name, urls, process, repeat):
+    '''
+    Run process(url) over urls repeat times, returning the stats and the
+    output of the last run for every url.
+    '''
+    latencies, outputs = [], {}
+    rss = peak_rss_mb()
+    start = time.time()
+    for i in xrange(repeat):
+        for url in urls:
+            t = time.time()
+            outputs[url] = jsonable(process(url))
+            latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    stats = {'pages': len(urls),
+             'pages_per_sec': len(latencies) / elapsed if elapsed else 0,
+             'p50_ms': 1000 * percentile(latencies, 50),
+             'p90_ms': 1000 * percentile(latencies, 90),
+             'p99_ms': 1000 * percentile(latencies, 99),
+             'peak_rss_growth_mb': peak_rss_mb() - rss}
+    return (name, stats), outputs
+
+
+def bench_replay(path, repeat=3, update_golden=False):
+    '''
+    Run parse_details_page -> Worker.parse_details and fetch_raw ->
+    parse_results_page over a recorded corpus, and check the extracted
+    data against the golden output stored with the corpus.
+    '''
+    import json, os
+    from calibre_plugins.DANGDANG.replay import Corpus, ReplayBrowser
+    dd = load_plugin()
+    plugin = bench_plugin(dd)
+    corpus = Corpus(path)
+    br = ReplayBrowser(corpus)
+    log = Log()
+
+    def details(url):
+        ans = dd.parse_details_page(url, log, 30, br)
+        if ans is not None:
+            return extract(dd, plugin, ans[0], ans[1], url)
+
+    def mobile(url):
+        from calibre_plugins.DANGDANG.mobile import parse_record
+        return parse_record(corpus.get(url), dd.dang_id_from_url(url),
+                            dd.Worker.optional_fields)
+
+    def search(url):
+        ans = plugin.fetch_raw(log, url, br, False)
+        if isinstance(ans, tuple) and ans[0]:
+            return plugin.parse_results_page(ans[1])
+        return []
+
+    rows, outputs = [], {}
+    for name, urls, process in (('details', list(corpus.urls('details')), details),
+                                ('mobile', list(corpus.urls('mobile')), mobile),
+                                ('search', list(corpus.urls('search')), search)):
+        if not urls and name == 'mobile':
+            continue
+        row, outputs[name] = run_pipeline(name, urls, process, repeat)
+        row[1]['kb_per_page'] = sum(len(corpus.get(u)) for u in urls) / 1024 / max(1, len(urls))
+        rows.append(row)
+
+    golden_path = os.path.join(path, 'golden.json')
+    if update_golden or not os.path.exists(golden_path):
+        with open(golden_path, 'wb') as f:
+            f.write(json.dumps(outputs, indent=2, sort_keys=True).encode('utf-8'))
+        print('Golden output written to', golden_path)
+        return rows, 0
+
+    with open(golden_path, 'rb') as f:
+        golden = json.loads(f.read())
+    failures = 0
+    for kind, expected in golden.iteritems():
+        for url, val in expected.iteritems():
+            if outputs.get(kind, {}).get(url) != val:
+                failures += 1
+                print('Golden mismatch for %s page: %s' % (kind, url))
+    return rows, failures
+
+
+def bench_index(count=200000, lookups=2000):
+    '''
+    Fill a temporary local index with count made up books, then time
+    lookups by title and author tokens and by ISBN.
+    '''
+    import os, random, shutil, tempfile
+    from calibre_plugins.DANGDANG.index import ProductIndex
+    rand = random.Random(42)
+    lookups = min(lookups, count)
+    words = ['w%d' % i for i in xrange(20000)]
+    names = ['a%d' % i for i in xrange(5000)]
+    books = []
+    for i in xrange(count):
+        title = ' '.join(rand.sample(words, rand.randint(1, 4)))
+        books.append(('%d' % (20000000 + i), title, [rand.choice(names)], '978%010d' % i))
+    tdir = tempfile.mkdtemp()
+    try:
+        index = ProductIndex(os.path.join(tdir, 'products.sqlite'))
+        start = time.time()
+        index.add_many((dang_id, title, authors, isbn, None,
+                        ['t:' + t for t in title.split()] + ['a:' + a for a in authors])
+                       for dang_id, title, authors, isbn in books)
+        rows = [('add', {'books': count, 'books_per_sec': count / (time.time() - start),
+                         'db_mb': os.path.getsize(index.path) / (1024 * 1024)})]
+        for label, lookup in (
+                ('title and author', lambda b: index.lookup(['t:' + t for t in b[1].split()] + ['a:' + b[2][0]])),
+                ('isbn', lambda b: index.lookup_isbn(b[3]))):
+            latencies, found = [], 0
+            for b in rand.sample(books, lookups):
+                t = time.time()
+                found += any(r[0] == b[0] for r in lookup(b))
+                latencies.append(time.time() - t)
+            rows.append((label, {'lookups': lookups, 'found': found,
+                                 'p50_ms': 1000 * percentile(latencies, 50),
+                                 'p99_ms': 1000 * percentile(latencies, 99)}))
+        index.conn.close()
+        return rows
+    finally:
+        shutil.rmtree(tdir)
+
+
+def bench_scaling(path, repeat=3, threads=8, count=200):
+    '''
+    Parse count details pages of a recorded corpus from threads fetch
+    threads, first in the threads themselves, then with parse pools of one
+    process up to one per core, and check that the parse pools extract the
+    same records.
+    '''
+    from multiprocessing import cpu_count
+    from threading import Thread
+    from Queue import Queue, Empty
+    from calibre_plugins.DANGDANG.replay import Corpus
+    from calibre_plugins.DANGDANG.parsepool import ParsePool
+    dd = load_plugin()
+    corpus = Corpus(path)
+    pages = [(url, corpus.get(url)) for url in corpus.urls('details')]
+    if not pages:
+        raise SystemExit('No details pages in the corpus: %s' % path)
+    work = [pages[i % len(pages)] for i in xrange(count)]
+    log = Log()
+    fields = dd.Worker.optional_fields
+
+    def in_thread(raw, url):
+        ans = dd.parse_details_raw(raw, url, log)
+        if ans is not None:
+            return dd.Worker(url, None, None, log, 0, None).extract_fields(*ans)
+
+    def run(parse):
+        tasks, results = Queue(), {}
+        for item in work:
+            tasks.put(item)
+
+        def fetch_thread():
+            while True:
+                try:
+                    url, raw = tasks.get_nowait()
+                except Empty:
+                    return
+                results[url] = parse(raw, url)
+
+        workers = [Thread(target=fetch_thread) for i in xrange(threads)]
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return time.time() - start, results
+
+    def best_of(parse):
+        runs = [run(parse) for i in xrange(repeat)]
+        return min(r[0] for r in runs), runs[-1][1]
+
+    baseline, expected = best_of(in_thread)
+    rows = [('threads only', {'pages': count, 'pages_per_sec': count / baseline})]
+    cores = cpu_count()
+    for processes in sorted(set([n for n in (1, 2, 4, 8, 16) if n < cores] + [cores])):
+        pool = ParsePool(processes)
+        try:
+            elapsed, results = best_of(lambda raw, url: pool.extract(raw, url, fields, log))
+        finally:
+            pool.shutdown()
+        rows.append(('%d processes' % processes, {
+            'pages': count, 'pages_per_sec': count / elapsed,
+            'speedup': baseline / elapsed,
+            'parity_mismatches': sum(1 for url in expected if results.get(url) != expected[url])}))
+    return rows
+
+
+def record(path, queries, timeout=30, mobile=False):
+    '''
+    Run identify for every query, saving all downloaded pages into the
+    corpus at path. A query is isbn:<isbn>, dang:<id> or title|author. If
+    mobile is True, the mobile pages of the books found are saved too.
+    '''
+    from threading import Event
+    from Queue import Queue
+    from calibre.utils.logging import default_log
+    from calibre_plugins.DANGDANG import replay
+    dd = load_plugin()
+    plugin = dd.Dang(None)
+    replay.start_recording(path)
+    try:
+        for q in queries:
+            title = authors = None
+            identifiers = {}
+            if q.startswith('isbn:') or q.startswith('dang:'):
+                k, v = q.split(':', 1)
+                identifiers[k] = v
+            else:
+                title, _, author = q.partition('|')
+                authors = [author] if author else None
+            plugin.identify(default_log, Queue(), Event(), title=title,
+                            authors=authors, identifiers=identifiers, timeout=timeout)
+        if mobile:
+            from calibre_plugins.DANGDANG.mobile import mobile_url
+            corpus = replay.active_recorder
+            for url in list(corpus.urls('details')):
+                try:
+                    dd.open_page(mobile_url(dd.dang_id_from_url(url)), timeout, plugin.browser)
+                except Exception:
+                    default_log.exception('Failed to download mobile page for: %r'%url)
+    finally:
+        replay.stop_recording()
+
+
+def report(rows):
+    for label, stats in rows:
+        print(label)
+        for k in sorted(stats):
+            print('  %-26s %.2f' % (k, stats[k]))
+
+
+def main(args=sys.argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='Print the per stage timings and counters'
+                        ' aggregated over the whole run, as JSON')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('details', help='Details page decode and parse')
+    p.add_argument('pages', nargs='+')
+    p = sub.add_parser('parsers', help='HTML parser backends, speed and extraction parity')
+    p.add_argument('pages', nargs='+')
+    p = sub.add_parser('normalize', help='Text clean up, speed and parity with the old code')
+    p.add_argument('pages', nargs='*')
+    p = sub.add_parser('fields', help='Field extraction cost for all fields and for subsets')
+    p.add_argument('pages', nargs='+')
+    p = sub.add_parser('startup', help='Plugin import time and Worker construction cost')
+    p.add_argument('--count', type=int, default=10000)
+    p = sub.add_parser('record', help='Record pages downloaded by identify into a corpus')
+    p.add_argument('corpus')
+    p.add_argument('queries', nargs='+', help='isbn:<isbn>, dang:<id> or title|author')
+    p.add_argument('--mobile', action='store_true', default=False,
+                   help='Also record the mobile pages of the books found')
+    p = sub.add_parser('replay', help='Benchmark the pipeline over a recorded corpus'
+                       ' and check it against the golden output')
+    p.add_argument('corpus')
+    p.add_argument('--update-golden', action='store_true', default=False)
+    p = sub.add_parser('index', help='Local index size, insertion and lookup speed')
+    p.add_argument('--count', type=int, default=200000)
+    p = sub.add_parser('scaling', help='Details page parsing throughput with parse'
+                       ' processes, for one up to one process per core')
+    p.add_argument('corpus')
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--count', type=int, default=200)
+    opts = parser.parse_args(args[1:])
+
+    if opts.command == 'details':
+        report(bench_details(load_pages(opts.pages), opts.repeat))
+    elif opts.command == 'parsers':
+        report(bench_parsers(load_pages(opts.pages), opts.repeat))
+    elif opts.command == 'normalize':
+        report(bench_normalize(load_pages(opts.pages), opts.repeat))
+    elif opts.command == 'fields':
+        report(bench_fields(load_pages(opts.pages), opts.repeat))
+    elif opts.command == 'startup':
+        report(bench_startup(opts.count, opts.repeat))
+    elif opts.command == 'record':
+        record(opts.corpus, [q.decode('utf-8') if isinstance(q, bytes) else q
+                             for q in opts.queries], mobile=opts.mobile)
+    elif opts.command == 'replay':
+        rows, failures = bench_replay(opts.corpus, opts.repeat, opts.update_golden)
+        report(rows)
+        if failures:
+            raise SystemExit('%d pages differ from the golden output' % failures)
+    elif opts.command == 'index':
+        report(bench_index(opts.count))
+    elif opts.command == 'scaling':
+        report(bench_scaling(opts.corpus, opts.repeat, opts.threads, opts.count))
+    if opts.timings:
+        from calibre_plugins.DANGDANG import timing
+        print(timing.totals.to_json())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, time, hashlib, sqlite3
+from threading import RLock
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_SIZE = 200 * 1024 * 1024
+
+
+def cache_root():
+    from calibre.constants import cache_dir
+    ans = os.path.join(cache_dir(), 'metadata-sources', 'dangdang')
+    if not os.path.exists(ans):
+        try:
+            os.makedirs(ans)
+        except EnvironmentError:
+            if not os.path.isdir(ans):
+                raise
+    return ans
+
+
+def normalize_url(url):
+    '''
+    Return a canonical form of url so that trivially different spellings of
+    the same page (host case, default port, query parameter order, fragment)
+    share a cache entry.
+    '''
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+    if isinstance(url, unicode):
+        # Work on bytes, query values are percent encoded gb18030
+        url = url.encode('utf-8')
+    scheme, netloc, path, query, fragment = urlsplit(url.strip())
+    scheme, netloc = scheme.lower(), netloc.lower()
+    if scheme == b'http' and netloc.endswith(b':80'):
+        netloc = netloc[:-3]
+    elif scheme == b'https' and netloc.endswith(b':443'):
+        netloc = netloc[:-4]
+    while b'//' in path:
+        path = path.replace(b'//', b'/')
+    if query:
+        query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path or b'/', query, b'')).decode('utf-8')
+
+
+class HttpCache(object):
+
+    '''
+    On-disk cache of fetched pages keyed by normalized URL. Bodies are stored
+    as individual files, the index (validators, timestamps, sizes) lives in a
+    small sqlite database next to them. Entries younger than ttl are served
+    without touching the network, older ones are revalidated with
+    If-None-Match/If-Modified-Since. The total size of stored bodies is kept
+    under max_size by evicting the least recently used entries.
+    '''
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl, self.max_size = ttl, max_size
+        self.lock = RLock()
+        self.bodies = os.path.join(path, 'bodies')
+        if not os.path.exists(self.bodies):
+            os.makedirs(self.bodies)
+        self.conn = sqlite3.connect(os.path.join(path, 'http.sqlite'),
+                                    check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS pages (
+            key TEXT PRIMARY KEY, url TEXT, etag TEXT, last_modified TEXT,
+            fetched REAL, accessed REAL, size INTEGER)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+        self.conn.commit()
+
+    def key(self, url):
+        return hashlib.sha1(normalize_url(url).encode('utf-8')).hexdigest()
+
+    def body_path(self, key):
+        return os.path.join(self.bodies, key[:2], key)
+
+    def lookup(self, url):
+        '''
+        Return (body, etag, last_modified, fresh) or None if url is not cached.
+        '''
+        key = self.key(url)
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified, fetched FROM pages WHERE key=?',
+                                    (key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.body_path(key), 'rb') as f:
+                    body = f.read()
+            except EnvironmentError:
+                self._delete(key)
+                return None
+            now = time.time()
+            self.conn.execute('UPDATE pages SET accessed=? WHERE key=?', (now, key))
+            self.conn.commit()
+        etag, last_modified, fetched = row
+        return body, etag, last_modified, now - fetched < self.ttl
+
+    def store(self, url, body, etag=None, last_modified=None):
+        key = self.key(url)
+        path = self.body_path(key)
+        with self.lock:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(body)
+            now = time.time()
+            self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?,?,?,?,?,?,?)',
+                              (key, normalize_url(url), etag, last_modified, now, now, len(body)))
+            self.conn.commit()
+            self.evict()
+
+    def refresh(self, url):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE pages SET fetched=?, accessed=? WHERE key=?',
+                              (now, now, self.key(url)))
+            self.conn.commit()
+
+    def evict(self):
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+            if total <= self.max_size:
+                return
+            for key, size in self.conn.execute(
+                    'SELECT key, size FROM pages ORDER BY accessed ASC').fetchall():
+                self._delete(key, commit=False)
+                total -= size
+                if total <= self.max_size:
+                    break
+            self.conn.commit()
+
+    def _delete(self, key, commit=True):
+        try:
+            os.remove(self.body_path(key))
+        except EnvironmentError:
+            pass
+        self.conn.execute('DELETE FROM pages WHERE key=?', (key,))
+        if commit:
+            self.conn.commit()
+
+    def invalidate(self, url):
+        with self.lock:
+            self._delete(self.key(url))
+
+    def clear(self):
+        with self.lock:
+            for (key,) in self.conn.execute('SELECT key FROM pages').fetchall():
+                self._delete(key, commit=False)
+            self.conn.commit()
+
+    def open(self, browser, url, timeout, cached):
+        '''
+        Open url on the network, revalidating the cached entry if there is
+        one. Returns the response, or None if the cached entry is still valid.
+        '''
+        headers = {}
+        if cached is not None:
+            if cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                headers['If-Modified-Since'] = cached[2]
+
+        if headers:
+            import mechanize
+            request = mechanize.Request(url, headers=headers)
+        else:
+            request = url
+        try:
+            return browser.open_novisit(request, timeout=timeout)
+        except Exception as e:
+            if cached is not None and callable(getattr(e, 'getcode', None)) and \
+                    e.getcode() == 304:
+                self.refresh(url)
+                return None
+            raise
+
+    def fetch(self, browser, url, timeout):
+        '''
+        Return the raw bytes of url, going to the network only when there is
+        no fresh cached copy. Network errors are propagated unchanged so that
+        callers can keep inspecting them (404s, timeouts, etc.).
+        '''
+        from calibre_plugins.DANGDANG import timing
+        cached = self.lookup(url)
+        if cached is not None and cached[3]:
+            timing.incr('cache_hits')
+            return cached[0]
+        response = self.open(browser, url, timeout, cached)
+        if response is None:
+            timing.incr('cache_revalidated')
+            return cached[0]
+        timing.incr('cache_misses')
+        with timing.span('download'):
+            body = response.read()
+        info = response.info()
+        self.store(url, body, etag=info.get('ETag'),
+                   last_modified=info.get('Last-Modified'))
+        return body
+
+    def fetch_stream(self, browser, url, timeout, consume, chunk_size):
+        '''
+        Like :meth:`fetch` but pass the page to consume in chunks of at most
+        chunk_size bytes. Reading stops as soon as consume returns True. The
+        page is cached only if it was read to the end, so that :meth:`fetch`
+        never returns a truncated page. Returns the bytes read.
+        '''
+        from calibre_plugins.DANGDANG import timing
+        cached = self.lookup(url)
+        response = None
+        if cached is None or not cached[3]:
+            response = self.open(browser, url, timeout, cached)
+        if response is None:
+            timing.incr('cache_hits' if cached[3] else 'cache_revalidated')
+            body = cached[0]
+            for i in xrange(0, len(body), chunk_size):
+                if consume(body[i:i+chunk_size]):
+                    break
+            return body
+
+        timing.incr('cache_misses')
+        chunks, complete = [], False
+        while True:
+            with timing.span('download'):
+                data = response.read(chunk_size)
+            if not data:
+                complete = True
+                break
+            chunks.append(data)
+            if consume(data):
+                break
+        try:
+            response.close()
+        except Exception:
+            pass
+        body = b''.join(chunks)
+        if complete:
+            info = response.info()
+            self.store(url, body, etag=info.get('ETag'),
+                       last_modified=info.get('Last-Modified'))
+        return body
+
+
+_http_cache = None
+_http_cache_lock = RLock()
+
+
+def get_http_cache(ttl=None, max_size=None):
+    '''
+    Return the process wide HttpCache, creating it on first use. If ttl or
+    max_size are given, the cache is reconfigured with them.
+    '''
+    global _http_cache
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = HttpCache(cache_root())
+        if ttl is not None:
+            _http_cache.ttl = ttl
+        if max_size is not None:
+            _http_cache.max_size = max_size
+        return _http_cache
+
+
+class IdentifierStore(object):
+
+    '''
+    Persistent ISBN -> dang id and dang id -> cover URL mappings, so that
+    covers can be found across calibre restarts without running identify,
+    and the search queries that found nothing. The database is only opened
+    on first use.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS isbn_map (isbn TEXT PRIMARY KEY, dang_id TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cover_map (dang_id TEXT PRIMARY KEY, url TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS misses (query TEXT PRIMARY KEY,'
+                         ' stage TEXT, reason TEXT, time REAL)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _get(self, table, column, key_column, key):
+        with self.lock:
+            row = self.conn.execute('SELECT %s FROM %s WHERE %s=?' % (column, table, key_column),
+                                    (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set(self, table, key, val):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO %s VALUES (?,?)' % table, (key, val))
+            self.conn.commit()
+
+    def isbn_to_identifier(self, isbn):
+        return self._get('isbn_map', 'dang_id', 'isbn', isbn)
+
+    def set_isbn_to_identifier(self, isbn, dang_id):
+        self._set('isbn_map', isbn, dang_id)
+
+    def identifier_to_cover_url(self, dang_id):
+        return self._get('cover_map', 'url', 'dang_id', dang_id)
+
+    def set_identifier_to_cover_url(self, dang_id, url):
+        self._set('cover_map', dang_id, url)
+
+    def missed_query(self, query, ttl):
+        '''
+        Return (stage, reason, age) if the search query found nothing less
+        than ttl seconds ago, otherwise None.
+        '''
+        key = normalize_url(query)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT stage, reason, time FROM misses WHERE query=?',
+                                    (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[2] >= ttl:
+                self.conn.execute('DELETE FROM misses WHERE query=?', (key,))
+                self.conn.commit()
+                return None
+        return row[0], row[1], now - row[2]
+
+    def set_missed_query(self, query, stage, reason):
+        '''
+        Record that the search query found nothing. stage is the fallback
+        stage the query was made at, reason why it failed.
+        '''
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO misses VALUES (?,?,?,?)',
+                              (normalize_url(query), stage, reason, time.time()))
+            self.conn.commit()
+
+
+_identifier_store = None
+
+
+def get_identifier_store():
+    global _identifier_store
+    with _http_cache_lock:
+        if _identifier_store is None:
+            _identifier_store = IdentifierStore(os.path.join(cache_root(), 'identifiers.sqlite'))
+        return _identifier_store
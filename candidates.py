@@ -0,0 +1,204 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Candidate books read from a search results page. Every result item
+already shows the title, authors and publisher of the book, which is
+enough to tell the obviously wrong results apart before downloading their
+details pages.
+'''
+
+import re
+from collections import namedtuple
+
+MAX_CANDIDATES = 5
+# Results of an ISBN search worth checking against their details pages
+MAX_ISBN_CANDIDATES = 3
+MIN_SCORE = 0.5
+CONFIDENT_SCORE = 1.0
+TITLE_WEIGHT, AUTHOR_WEIGHT = 0.7, 0.3
+
+# isbn is the ISBN the book is expected to have, to be checked against its
+# details page, or None
+Candidate = namedtuple('Candidate', 'url rank title authors publisher pubdate cover_url score isbn')
+
+BAD_TITLES = ('bulk pack', '[audiobook]', '[audio cd]', '(a book companion)',
+              '( slipcase with door )', ': free sampler')
+
+date_pat = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+squash_pat = re.compile(r'[\s\-_:;,.!?·•()\[\]（）【】《》：；，。！？、]+', re.U)
+
+
+def squash(text):
+    return squash_pat.sub('', icu_lower(text or ''))
+
+
+def title_ok(title):
+    title = icu_lower(title or '')
+    for x in BAD_TITLES:
+        if x in title:
+            return False
+    return True
+
+
+def parse_candidates(root):
+    '''
+    Return a Candidate for every result on the search results page, in the
+    order they appear. Fields that cannot be found are None.
+    '''
+    from lxml.html import tostring
+    from calibre_plugins.DANGDANG import xpaths
+
+    def text(elem):
+        return (elem.get('title') or tostring(elem, method='text', encoding=unicode)).strip()
+
+    ans = []
+    for li in xpaths.result_items(root):
+        links = xpaths.item_link(li)
+        if not links:
+            continue
+        url = links[0].get('href')
+        if url.startswith('/'):
+            url = 'http://product.dangdang.com/%s' % (url)
+        title = xpaths.item_title(li)
+        title = text(title[0]) if title else links[0].get('title')
+        authors = [text(a) for a in xpaths.item_authors(li)] or None
+        publisher = xpaths.item_publisher(li)
+        publisher = text(publisher[0]) if publisher else None
+        pubdate = None
+        for line in xpaths.item_author_line(li):
+            m = date_pat.search(tostring(line, method='text', encoding=unicode))
+            if m is not None:
+                pubdate = m.group()
+        cover_url = None
+        for img in xpaths.item_image(li):
+            # Images below the fold are lazy loaded from data-original
+            for attr in ('data-original', 'src'):
+                src = img.get(attr)
+                if src and 'blank.gif' not in src and 'url_none' not in src:
+                    cover_url = src
+                    break
+        ans.append(Candidate(url, len(ans), title, authors, publisher, pubdate,
+                             cover_url, None, None))
+    return ans
+
+
+def fingerprint(candidate):
+    '''
+    The squashed title, authors and publisher of candidate, the same for
+    the dangdang.com listing of a book and those of marketplace sellers, or
+    None if the result item does not show the title and authors.
+    '''
+    if not candidate.title or not candidate.authors:
+        return None
+    return (squash(candidate.title), squash(''.join(candidate.authors)),
+            squash(candidate.publisher))
+
+
+def richness(candidate):
+    return sum(1 for x in (candidate.publisher, candidate.pubdate, candidate.cover_url) if x)
+
+
+def dedupe(candidates):
+    '''
+    Collapse candidates with the same fingerprint into the one showing the
+    most information, in the place of the first of them.
+    '''
+    ans, seen = [], {}
+    for c in candidates:
+        key = fingerprint(c)
+        if key is None:
+            ans.append(c)
+            continue
+        i = seen.get(key)
+        if i is None:
+            seen[key] = len(ans)
+            ans.append(c)
+        elif richness(c) > richness(ans[i]):
+            ans[i] = c
+    if len(ans) < len(candidates):
+        from calibre_plugins.DANGDANG import timing
+        timing.incr('duplicate_candidates', len(candidates) - len(ans))
+    return ans
+
+
+def score(candidate, title_tokens, author_tokens):
+    '''
+    How well candidate matches the query, between 0 and 1, or None if the
+    result item did not show the information needed to tell.
+    '''
+    title_tokens = [squash(t) for t in title_tokens if squash(t)]
+    author_tokens = [squash(t) for t in author_tokens if squash(t)]
+    if not title_tokens and not author_tokens:
+        return None
+    total = weight = 0
+    if title_tokens:
+        if not candidate.title:
+            return None
+        title = squash(candidate.title)
+        total += TITLE_WEIGHT * sum(1 for t in title_tokens if t in title) / len(title_tokens)
+        weight += TITLE_WEIGHT
+    if author_tokens and candidate.authors:
+        authors = squash(''.join(candidate.authors))
+        total += AUTHOR_WEIGHT * sum(1 for t in author_tokens if t in authors) / len(author_tokens)
+        weight += AUTHOR_WEIGHT
+    return total / weight
+
+
+def rank(candidates, title_tokens=(), author_tokens=(), isbn=None):
+    '''
+    Return the candidates worth fetching the details page of, best first,
+    with their score set. isbn is the ISBN searched for: the results page
+    does not show the ISBN of the results, which may be other editions, so
+    the first MAX_ISBN_CANDIDATES are kept in search order with their isbn
+    set, to be checked against their details pages. They are not deduped,
+    as listings that look alike may be different printings. Otherwise
+    results scoring below MIN_SCORE are dropped, unless none of them could
+    be scored, in which case the search order is kept. The best result is
+    always kept, even if it scores below MIN_SCORE. Several listings of the
+    same book are kept only once, see :func:`dedupe`.
+    '''
+    candidates = [c for c in candidates if title_ok(c.title)]
+    if isbn:
+        return [c._replace(isbn=isbn) for c in candidates[:MAX_ISBN_CANDIDATES]]
+    scored = [(score(c, title_tokens, author_tokens), c) for c in candidates]
+    if all(s is None for s, c in scored):
+        return dedupe(candidates)[:MAX_CANDIDATES]
+    scored.sort(key=lambda x: (-(x[0] or 0), x[1].rank))
+    kept = scored[:1] + [(s, c) for s, c in scored[1:] if s is None or s >= MIN_SCORE]
+    return dedupe([c._replace(score=s) for s, c in kept])[:MAX_CANDIDATES]
+
+
+def confident(candidates):
+    '''
+    True if the best of the ranked candidates matches every query token.
+    '''
+    return bool(candidates) and candidates[0].score is not None and \
+        candidates[0].score >= CONFIDENT_SCORE
+
+
+def isbn13(isbn):
+    '''
+    The ISBN-13 form of isbn, a valid ISBN as returned by check_isbn.
+    '''
+    if len(isbn) == 10:
+        isbn = '978' + isbn[:9]
+        total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(isbn))
+        isbn += unicode((10 - total % 10) % 10)
+    return isbn
+
+
+def isbn_matches(expected, isbn):
+    '''
+    False if isbn, found on the details page of a candidate, is not the
+    ISBN expected of it. True if either is not known.
+    '''
+    from calibre.ebooks.metadata import check_isbn
+    expected, isbn = check_isbn(expected), check_isbn(isbn)
+    return not expected or not isbn or isbn13(expected) == isbn13(isbn)
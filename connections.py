@@ -0,0 +1,175 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import socket, zlib, httplib, urllib2
+from urlparse import urlsplit, urljoin
+from threading import RLock
+from StringIO import StringIO
+
+MAX_IDLE_PER_HOST = 8
+MAX_REDIRECTS = 5
+
+
+class Response(object):
+
+    def __init__(self, url, code, headers, data):
+        self.url, self.code, self.headers = url, code, headers
+        self.fp = StringIO(data)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        pass
+
+
+class Headers(dict):
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+
+class KeepAliveBrowser(object):
+
+    '''
+    A minimal stand-in for the mechanize browser that keeps HTTP/1.1
+    connections to each host open and reuses them across requests and
+    threads, so that a search page and the detail pages it links to share
+    a handful of connections instead of opening one per request.
+
+    Only the parts of the browser API used by this plugin are provided:
+    :meth:`open_novisit` and :meth:`clone_browser`. Errors are raised as
+    urllib2 exceptions so that callers can inspect them the same way as
+    errors from mechanize.
+    '''
+
+    def __init__(self, user_agent, max_idle_per_host=MAX_IDLE_PER_HOST):
+        self.user_agent = user_agent
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.lock = RLock()
+
+    def clone_browser(self):
+        # Clones share the connection pool, that is the point
+        return self
+
+    def acquire(self, scheme, host, timeout):
+        key = (scheme, host)
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return cls(host, timeout=timeout), False
+
+    def release(self, scheme, host, conn):
+        key = (scheme, host)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def request(self, url, headers, timeout):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        hdrs = {'User-Agent':self.user_agent, 'Accept-Encoding':'gzip, deflate',
+                'Connection':'keep-alive'}
+        hdrs.update(headers)
+        while True:
+            conn, reused = self.acquire(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request('GET', path, headers=hdrs)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # The server closed an idle connection, retry once on a
+                    # fresh one
+                    reused = False
+                    with self.lock:
+                        stale = self.idle.pop((parts.scheme, parts.netloc), ())
+                    for c in stale:
+                        c.close()
+                    continue
+                if isinstance(e, socket.timeout):
+                    raise urllib2.URLError(e)
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(parts.scheme, parts.netloc, conn)
+
+        rheaders = Headers((k.lower(), v) for k, v in response.getheaders())
+        encoding = rheaders.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
+        return response.status, rheaders, data
+
+    def open_novisit(self, url_or_request, timeout=30):
+        if isinstance(url_or_request, basestring):
+            url, headers = url_or_request, {}
+        else:
+            url = url_or_request.get_full_url()
+            headers = dict(url_or_request.header_items())
+        for i in xrange(MAX_REDIRECTS + 1):
+            code, headers_, data = self.request(url, headers, timeout)
+            if code in (301, 302, 303, 307) and headers_.get('location'):
+                url = urljoin(url, headers_.get('location'))
+                continue
+            break
+        if code >= 300:
+            raise urllib2.HTTPError(url, code, httplib.responses.get(code, ''),
+                                    headers_, StringIO(data))
+        return Response(url, code, headers_, data)
+
+
+_keepalive_browser = None
+_keepalive_lock = RLock()
+
+
+def get_keepalive_browser(user_agent):
+    global _keepalive_browser
+    with _keepalive_lock:
+        if _keepalive_browser is None:
+            _keepalive_browser = KeepAliveBrowser(user_agent)
+        return _keepalive_browser
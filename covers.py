@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, time, hashlib, sqlite3
+from threading import RLock
+
+from calibre_plugins.DANGDANG.cache import cache_root, normalize_url
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+
+
+def trim(data):
+    '''
+    Return the cover image data with its borders removed, as calibre does
+    for plugins with auto_trim_covers, or None if the image cannot be
+    processed.
+    '''
+    try:
+        from calibre.utils.img import (image_from_data, image_to_data,
+                                       remove_borders_from_image)
+    except ImportError:
+        return None
+    try:
+        img = image_from_data(data)
+        nimg = remove_borders_from_image(img)
+        return data if nimg is img else image_to_data(nimg)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+
+
+def make_variants(data):
+    '''
+    Return a dict of the pre-processed versions of the cover image data,
+    'trimmed' is the output of :func:`trim`. Returns an empty dict if the
+    image cannot be processed.
+    '''
+    trimmed = trim(data)
+    return {} if trimmed is None else {'trimmed': trimmed}
+
+
+class CoverCache(object):
+
+    '''
+    Content addressed on-disk cache of cover images. Images are stored once
+    per distinct content, whatever the number of URLs and dang ids pointing
+    to them, along with their pre-processed variants. The total size is
+    kept under max_size by evicting the least recently used images.
+    '''
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path, self.max_size = path, max_size
+        self.lock = RLock()
+        self.blobs = os.path.join(path, 'covers')
+        if not os.path.exists(self.blobs):
+            os.makedirs(self.blobs)
+        self.conn = sqlite3.connect(os.path.join(path, 'covers.sqlite'),
+                                    check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS covers (url TEXT PRIMARY KEY,'
+                          ' dang_id TEXT, digest TEXT, added REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS covers_dang_id ON covers (dang_id)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT, variant TEXT,'
+                          ' size INTEGER, accessed REAL, PRIMARY KEY (digest, variant))')
+        self.conn.commit()
+
+    def blob_path(self, digest, variant):
+        return os.path.join(self.blobs, digest[:2], '%s.%s' % (digest, variant))
+
+    def digest(self, url=None, dang_id=None):
+        if url is not None:
+            row = self.conn.execute('SELECT digest FROM covers WHERE url=?',
+                                    (normalize_url(url),)).fetchone()
+            if row is not None:
+                return row[0]
+        if dang_id is not None:
+            row = self.conn.execute('SELECT digest FROM covers WHERE dang_id=?'
+                                    ' ORDER BY added DESC', (dang_id,)).fetchone()
+            if row is not None:
+                return row[0]
+
+    def get(self, url=None, dang_id=None, variant='full'):
+        '''
+        Return (variant, data) for the cached image for url or, failing
+        that, for dang_id. If the requested variant is not available the full
+        image is returned. Returns None if there is no cached image.
+        '''
+        with self.lock:
+            digest = self.digest(url, dang_id)
+            if digest is None:
+                return None
+            for v in (variant, 'full'):
+                try:
+                    with open(self.blob_path(digest, v), 'rb') as f:
+                        data = f.read()
+                except EnvironmentError:
+                    continue
+                self.conn.execute('UPDATE blobs SET accessed=? WHERE digest=?',
+                                  (time.time(), digest))
+                self.conn.commit()
+                return v, data
+
+    def put(self, url, dang_id, data, variants=None):
+        digest = hashlib.sha1(data).hexdigest()
+        variants = dict(variants or {})
+        variants['full'] = data
+        now = time.time()
+        with self.lock:
+            for variant, vdata in variants.iteritems():
+                path = self.blob_path(digest, variant)
+                if not os.path.exists(path):
+                    if not os.path.exists(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    with open(path, 'wb') as f:
+                        f.write(vdata)
+                self.conn.execute('INSERT OR REPLACE INTO blobs VALUES (?,?,?,?)',
+                                  (digest, variant, len(vdata), now))
+            self.conn.execute('INSERT OR REPLACE INTO covers VALUES (?,?,?,?)',
+                              (normalize_url(url), dang_id, digest, now))
+            self.conn.commit()
+            self.evict()
+        return digest
+
+    def evict(self):
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total <= self.max_size:
+                return
+            for digest, size, variants in self.conn.execute(
+                    'SELECT digest, SUM(size), GROUP_CONCAT(variant) FROM blobs'
+                    ' GROUP BY digest ORDER BY MAX(accessed) ASC').fetchall():
+                for variant in variants.split(','):
+                    try:
+                        os.remove(self.blob_path(digest, variant))
+                    except EnvironmentError:
+                        pass
+                self.conn.execute('DELETE FROM blobs WHERE digest=?', (digest,))
+                self.conn.execute('DELETE FROM covers WHERE digest=?', (digest,))
+                total -= size
+                if total <= self.max_size:
+                    break
+            self.conn.commit()
+
+
+_cover_cache = None
+_cover_cache_lock = RLock()
+
+
+def get_cover_cache(max_size=None):
+    global _cover_cache
+    with _cover_cache_lock:
+        if _cover_cache is None:
+            _cover_cache = CoverCache(cache_root())
+        if max_size is not None:
+            _cover_cache.max_size = max_size
+        return _cover_cache
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Persistent inverted index of the books already identified, so that looking
+up a book seen before, for example while identifying other parts of the
+library, does not need a search on dangdang.com. Each book is indexed under
+its title and author tokens, and its ISBN.
+'''
+
+import os, time, json, sqlite3
+from threading import RLock
+
+# Lookups returning more books than this are too vague to be useful
+MAX_HITS = 50
+
+
+class ProductIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            # authors is a JSON list
+            conn.execute('CREATE TABLE IF NOT EXISTS products (dang_id TEXT PRIMARY KEY,'
+                         ' title TEXT, authors TEXT, isbn TEXT, publisher TEXT, time REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS products_isbn ON products (isbn)')
+            # The primary key is the token -> dang_id posting list
+            conn.execute('CREATE TABLE IF NOT EXISTS tokens (token TEXT, dang_id TEXT,'
+                         ' PRIMARY KEY (token, dang_id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS tokens_dang_id ON tokens (dang_id)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def add(self, dang_id, title, authors, isbn, publisher, tokens):
+        '''
+        Add or replace the book dang_id, indexed under tokens. An isbn or
+        publisher of None keeps the one already stored, so that a book
+        parsed with fewer fields does not lose them.
+        '''
+        self.add_many([(dang_id, title, authors, isbn, publisher, tokens)])
+
+    def add_many(self, books):
+        '''
+        Like :meth:`add` for many (dang_id, title, authors, isbn, publisher,
+        tokens) tuples at once, in a single transaction.
+        '''
+        now = time.time()
+        with self.lock:
+            conn = self.conn
+            for dang_id, title, authors, isbn, publisher, tokens in books:
+                conn.execute('DELETE FROM tokens WHERE dang_id=?', (dang_id,))
+                conn.execute('INSERT OR REPLACE INTO products SELECT ?, ?, ?,'
+                             ' COALESCE(?, (SELECT isbn FROM products WHERE dang_id=?)),'
+                             ' COALESCE(?, (SELECT publisher FROM products WHERE dang_id=?)), ?',
+                             (dang_id, title, json.dumps(list(authors)), isbn, dang_id,
+                              publisher, dang_id, now))
+                conn.executemany('INSERT OR IGNORE INTO tokens VALUES (?,?)',
+                                 [(t, dang_id) for t in tokens])
+            conn.commit()
+
+    def _products(self, sql, args):
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        return [(dang_id, title, json.loads(authors) if authors else [], isbn, publisher)
+                for dang_id, title, authors, isbn, publisher in rows]
+
+    def lookup(self, tokens):
+        '''
+        Return (dang_id, title, authors, isbn, publisher) for the books
+        indexed under all of tokens, most recently added first.
+        '''
+        tokens = sorted(set(tokens))
+        if not tokens:
+            return []
+        return self._products(
+            'SELECT dang_id, title, authors, isbn, publisher FROM products WHERE dang_id IN'
+            ' (SELECT dang_id FROM tokens WHERE token IN (%s) GROUP BY dang_id HAVING COUNT(*)=?)'
+            ' ORDER BY time DESC LIMIT ?' % ','.join('?' * len(tokens)),
+            tokens + [len(tokens), MAX_HITS])
+
+    def lookup_isbn(self, isbn):
+        return self._products(
+            'SELECT dang_id, title, authors, isbn, publisher FROM products WHERE isbn=?'
+            ' ORDER BY time DESC LIMIT ?', (isbn, MAX_HITS))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM tokens')
+            self.conn.execute('DELETE FROM products')
+            self.conn.commit()
+
+
+_product_index = None
+_product_index_lock = RLock()
+
+
+def get_product_index():
+    global _product_index
+    with _product_index_lock:
+        if _product_index is None:
+            from calibre_plugins.DANGDANG.cache import cache_root
+            _product_index = ProductIndex(os.path.join(cache_root(), 'products.sqlite'))
+        return _product_index
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Details from the mobile product pages of dangdang.com, a small fraction
+of the size of the desktop pages. Only the <meta> tags in the page head
+are read, for the Open Graph book properties, the page is never parsed as
+a whole. Tags, series and publisher are not among those properties. If
+the title, authors or a field the caller requires cannot be found, the
+caller falls back to the desktop page.
+
+The property names and page layout handled here, and the pages under
+tests/fixtures, are written from the Open Graph book vocabulary, not
+recorded from product.m.dangdang.com. They should be checked against a
+real capture (benchmark.py record --mobile) before the mobile backend is
+relied on.
+'''
+
+import re
+
+MOBILE_URL = 'http://product.m.dangdang.com/%s.html'
+
+head_end_pat = re.compile(br'</head\s*>', re.I)
+meta_pat = re.compile(br'<meta\s[^>]*>', re.I)
+charset_pat = re.compile(br'''<meta\s[^>]*charset\s*=\s*["']?([-\w]+)''', re.I)
+author_separator_pat = re.compile(r'\s*[,，、;；/]\s*')
+
+
+def mobile_url(dang_id):
+    return MOBILE_URL % dang_id
+
+
+def head_meta(raw):
+    '''
+    Return a dict mapping the property or name of the <meta> tags in the
+    head of raw to the list of their contents.
+    '''
+    from lxml.html import fragment_fromstring
+    m = head_end_pat.search(raw)
+    head = raw if m is None else raw[:m.start()]
+    m = charset_pat.search(head)
+    encoding = m.group(1).decode('ascii') if m is not None else 'utf-8'
+    ans = {}
+    for tag in meta_pat.findall(head):
+        try:
+            meta = fragment_fromstring(tag.decode(encoding, 'replace'))
+        except Exception:
+            continue
+        name = meta.get('property') or meta.get('name')
+        content = (meta.get('content') or '').strip()
+        if name and content:
+            ans.setdefault(name.lower(), []).append(content)
+    return ans
+
+
+def parse_record(raw, dang_id, fields, required=frozenset()):
+    '''
+    Return a record like those of Worker.extract_fields from the raw bytes
+    of a mobile product page, or None if it lacks the title, authors or the
+    ISBN when it is one of required. A missing ISBN that is only one of
+    fields is left out of the record.
+    '''
+    from calibre.ebooks.metadata import check_isbn
+    meta = head_meta(raw)
+
+    def first(*names):
+        for name in names:
+            if meta.get(name):
+                return meta[name][0]
+
+    title = first('og:title')
+    authors = [a for x in meta.get('book:author', meta.get('author', ()))
+               for a in author_separator_pat.split(x) if a]
+    if not title or not authors:
+        return None
+    record = {'title': title, 'authors': authors, 'dang_id': dang_id}
+
+    if 'isbn' in fields:
+        isbn = check_isbn(first('book:isbn') or '')
+        if isbn:
+            record['isbn'] = isbn
+        elif 'isbn' in required:
+            return None
+    if 'cover' in fields:
+        record['cover_url'] = first('og:image')
+    if 'comments' in fields:
+        desc = first('og:description', 'description')
+        if desc:
+            from calibre import prepare_string_for_xml
+            record['comments'] = '<p>%s</p>' % prepare_string_for_xml(desc)
+    if 'pubdate' in fields:
+        date = first('book:release_date')
+        if date:
+            from calibre.utils.date import parse_only_date
+            try:
+                record['pubdate'] = parse_only_date(date, assume_utc=True)
+            except Exception:
+                pass
+    return record
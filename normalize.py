@@ -0,0 +1,137 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Text clean up used when extracting fields. All patterns are compiled once,
+and each clean up is done in a single pass over the text where possible.
+'''
+
+import re
+
+ENGLISH_MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                  'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+whitespace_pat = re.compile(r'\s+')
+
+# Comments {{{
+
+# In a single pass: the notice about text referring to out of print
+# editions, HTML comments, attributes of tags and runs of newlines and of
+# spaces. Applying these one after the other gives the same result, as no
+# replacement creates a match for another.
+comments_pat = re.compile(
+    r'(?s)(?P<drop><em(?:\s[^>]+)?>--This text ref.*?</em>|<!--.*?-->)'
+    r'|<(?P<tag>[a-zA-Z0-9]+)\s[^>]+>'
+    r'|(?P<nl>\n\n+)'
+    r'|(?P<sp>  +)')
+
+
+def _comments_repl(m):
+    g = m.lastgroup
+    if g == 'tag':
+        return '<%s>' % m.group('tag')
+    if g == 'nl':
+        return '\n'
+    if g == 'sp':
+        return ' '
+    return ''
+
+
+def clean_comments(text):
+    '''
+    Clean the text of a description before it is sanitized: fix the
+    replacement character used in place of quotes, strip tag attributes,
+    collapse runs of newlines and spaces and remove HTML comments.
+    '''
+    return comments_pat.sub(_comments_repl, text.replace('\ufffd', "'"))
+# }}}
+
+# Dates {{{
+
+date_junk_pat = re.compile('出版时间|[年月日:-]')
+date_junk_map = {'出版时间': '', '年': '/', '月': '/', '日': '', ':': '', '-': '/'}
+months_pat = re.compile('(1[0-2]|[1-9])月')
+
+
+def delocalize_datestr(raw):
+    '''
+    Replace Chinese month names by English ones, so that the date can be
+    parsed by calibre.
+    '''
+    ans = months_pat.sub(lambda m: ENGLISH_MONTHS[int(m.group(1))], raw.lower())
+    return ans.replace(' de ', ' ')
+
+
+def pubdate_text(raw):
+    '''
+    Turn a publication date as shown on details pages, such as
+    出版时间:2015年3月, into a date calibre can parse: 2015/3/1.
+    '''
+    ans = date_junk_pat.sub(lambda m: date_junk_map[m.group()], raw).strip()
+    if ans.endswith('/'):
+        ans += '1'
+    return delocalize_datestr(ans)
+# }}}
+
+# Titles and series {{{
+
+title_series_pat = re.compile(r'\S+\s+(\(.+?\s+Book\s+\d+\))$')
+book_of_pat = re.compile(r':\s*Book\s+\d+\s+of\s+$', re.I)
+book_number_pat = re.compile(r'\s+Book\s+\d+$', re.I)
+colon_pat = re.compile(r':\s*$')
+series_word_pat = re.compile(r'\s+Series$')
+series_paren_pat = re.compile(r'\(.+?\s+Series\)$')
+isbn_separator_pat = re.compile(r'(:|：|\n)+')
+
+
+def _endswith(text, suffix):
+    return len(text) >= len(suffix) and text[len(text)-len(suffix):].lower() == suffix.lower()
+
+
+def strip_series_from_title(title, series):
+    '''
+    Remove a trailing mention of series from title: "Title: Book 2 of
+    Series", "Title (Series)" or "Title: Series Book 2". Returns title
+    unchanged if there is none, or if nothing would be left.
+    '''
+    if _endswith(title, series):
+        head = title[:len(title)-len(series)]
+        m = book_of_pat.search(head)
+        if m is not None:
+            q = head[:m.start()].strip()
+            if q:
+                return q
+    if _endswith(title, '(%s)' % series):
+        q = title[:len(title)-len(series)-2].strip()
+        if q:
+            return q
+    m = book_number_pat.search(title)
+    if m is not None:
+        head = title[:m.start()]
+        if _endswith(head, series):
+            m = colon_pat.search(head[:len(head)-len(series)])
+            if m is not None:
+                q = head[:m.start()].strip()
+                if q:
+                    return q
+    return title
+
+
+def clean_series(series):
+    series = series_word_pat.sub('', series).strip()
+    return series_paren_pat.sub('', series).strip()
+
+
+def collapse_whitespace(text):
+    return whitespace_pat.sub(' ', text)
+
+
+def split_isbn_label(text):
+    return isbn_separator_pat.split(text)
+# }}}
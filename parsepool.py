@@ -0,0 +1,192 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Parsing of details pages in separate processes. Decoding, parsing and the
+field extractors are CPU bound Python code, so the fetch threads serialize
+on the GIL while running them. With a parse pool the fetch threads only
+download pages and hand the raw bytes to the pool, which returns the record
+built by Worker.extract_fields, along with the messages logged and the
+timings recorded while building it.
+
+Parse processes are calibre worker processes started with offload_worker,
+not forked, so they are safe to start from any thread, in the GUI and on
+every platform. They load the plugin like calibre does, so the plugin must
+be installed for them to work, pages are parsed in the fetch threads when a
+parse process fails.
+'''
+
+import atexit, traceback
+from threading import RLock
+from Queue import Queue, Empty
+
+# Give up waiting for an idle parse process after this long
+PARSE_TIMEOUT = 60
+
+
+class BufferLog(object):
+
+    '''
+    Keep the messages logged in a parse process, to be logged again by the
+    process that submitted the page.
+    '''
+
+    def __init__(self):
+        self.messages = []
+
+    def _add(self, level, args):
+        self.messages.append((level, ' '.join(unicode(x) for x in args)))
+
+    def debug(self, *args, **kwargs):
+        self._add('debug', args)
+
+    def info(self, *args, **kwargs):
+        self._add('info', args)
+
+    def warning(self, *args, **kwargs):
+        self._add('warning', args)
+    warn = warning
+
+    def error(self, *args, **kwargs):
+        self._add('error', args)
+
+    def exception(self, *args, **kwargs):
+        self._add('error', args + (traceback.format_exc().decode('utf-8', 'replace'),))
+
+
+def extract_record(raw, url, fields, backend, testing=False):
+    '''
+    Run in a parse process: decode and parse the raw bytes of the details
+    page at url and run the extractors for fields over it. Returns (status,
+    record, messages, timings) where status is 'ok', 'captcha' or 'error'.
+    '''
+    import calibre_plugins.DANGDANG as dd
+    from calibre_plugins.DANGDANG import timing
+    from calibre_plugins.DANGDANG.parsers import set_default_backend
+    set_default_backend(backend)
+    log = BufferLog()
+    status, record = 'error', None
+    with timing.collecting() as stats:
+        try:
+            ans = dd.parse_details_raw(raw, url, log)
+            if ans is not None:
+                w = dd.Worker(url, None, None, log, 0, None, testing=testing, fields=fields)
+                record = w.extract_fields(*ans)
+                status = 'ok'
+        except dd.CaptchaError:
+            status = 'captcha'
+        except Exception:
+            log.exception('Failed to parse details page: %r'%url)
+    return status, record, log.messages, (stats.spans, stats.counters)
+
+
+class ParsePool(object):
+
+    '''
+    Up to processes parse processes, started on first use and each used by
+    one fetch thread at a time.
+    '''
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.lock = RLock()
+        self.workers = []
+        self.idle = Queue()
+
+    def start_worker(self):
+        from calibre.utils.ipc.simple_worker import offload_worker
+        return offload_worker()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            start = len(self.workers) < self.processes
+            if start:
+                worker = self.start_worker()
+                self.workers.append(worker)
+        if start:
+            return worker
+        try:
+            return self.idle.get(timeout=PARSE_TIMEOUT)
+        except Empty:
+            raise Exception('Timed out waiting for a parse process')
+
+    def discard(self, worker):
+        with self.lock:
+            try:
+                self.workers.remove(worker)
+            except ValueError:
+                pass
+        try:
+            worker.shutdown()
+        except Exception:
+            pass
+
+    def extract(self, raw, url, fields, log, testing=False):
+        '''
+        Parse the raw bytes of the details page at url in a parse process.
+        Returns the record, or None if the page could not be used. Raises
+        CaptchaError for CAPTCHA pages and Exception if the parse process
+        failed.
+        '''
+        from calibre_plugins.DANGDANG import CaptchaError, timing
+        from calibre_plugins.DANGDANG.parsers import _default_backend
+        with timing.span('parse_process_wait'):
+            worker = self.acquire()
+        try:
+            with timing.span('parse_process'):
+                res = worker(__name__, 'extract_record', raw, url, frozenset(fields),
+                             _default_backend, testing)
+        except Exception:
+            # The process died, start a new one next time
+            self.discard(worker)
+            raise
+        self.idle.put(worker)
+        if res['tb']:
+            raise Exception('Parse process failed:\n' + res['tb'])
+        status, record, messages, (spans, counters) = res['result']
+        timing.add(spans, counters)
+        for level, msg in messages:
+            getattr(log, level)(msg)
+        if status == 'captcha':
+            raise CaptchaError('Amazon returned a CAPTCHA page, probably because you downloaded too many books. Wait for some time and try again.')
+        return record
+
+    def shutdown(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            try:
+                worker.shutdown()
+            except Exception:
+                pass
+
+
+_parse_pool = None
+_parse_pool_lock = RLock()
+
+
+def get_parse_pool(processes):
+    '''
+    Return the process wide ParsePool with the given number of processes,
+    or None if processes is zero.
+    '''
+    global _parse_pool
+    processes = max(0, int(processes or 0))
+    with _parse_pool_lock:
+        if _parse_pool is not None and _parse_pool.processes != processes:
+            _parse_pool.shutdown()
+            _parse_pool = None
+        if _parse_pool is None and processes:
+            _parse_pool = ParsePool(processes)
+            atexit.register(_parse_pool.shutdown)
+        return _parse_pool
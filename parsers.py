@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Anchors that must be present in a parsed details page. Each entry is a
+# group of alternatives, at least one of which must match.
+DETAILS_ANCHORS = (
+    ('//div[@class="name_info"]', '//img[@id="largePic"]'),
+    ('//*[@class="messbox_info"]', '//*[@class="book_messbox"]'),
+)
+
+SEARCH_ANCHORS = (
+    ('//li[starts-with(@class, "line")]',),
+)
+
+
+def parse_html5lib(raw):
+    import html5lib
+    return html5lib.parse(raw, treebuilder='lxml', namespaceHTMLElements=False)
+
+
+def parse_lxml(raw):
+    from lxml.html import document_fromstring
+    return document_fromstring(raw)
+
+
+def parse_html5_parser(raw):
+    from html5_parser import parse
+    return parse(raw, treebuilder='lxml', namespace_elements=False)
+
+
+def _available(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+BACKENDS = {
+    'html5-parser': parse_html5_parser,
+    'lxml': parse_lxml,
+    'html5lib': parse_html5lib,
+}
+
+_fast_backend = None
+_default_backend = 'auto'
+
+
+def set_default_backend(name):
+    '''
+    Select the backend used by :func:`parse_html`. 'auto' uses the fastest
+    available parser and falls back to html5lib only when needed.
+    '''
+    global _default_backend
+    _default_backend = name if name in BACKENDS else 'auto'
+
+
+def fast_backend():
+    global _fast_backend
+    if _fast_backend is None:
+        _fast_backend = 'html5-parser' if _available('html5_parser') else 'lxml'
+    return _fast_backend
+
+
+def has_anchors(root, anchors):
+    for group in anchors:
+        if not any(root.xpath(x) for x in group):
+            return False
+    return True
+
+
+def parse_html(raw, anchors=(), backend=None):
+    '''
+    Parse raw (unicode, with encoding declarations stripped) into an lxml
+    tree. With the 'auto' backend the fast parser is tried first, and the
+    page is re-parsed with html5lib if the fast parser fails or produces a
+    tree missing any of the anchors.
+    '''
+    backend = backend or _default_backend
+    if backend != 'auto':
+        return BACKENDS[backend](raw)
+    try:
+        root = BACKENDS[fast_backend()](raw)
+    except Exception:
+        root = None
+    if root is not None and has_anchors(root, anchors):
+        return root
+    return parse_html5lib(raw)
+
+
+def parse_fragment(markup, backend=None):
+    '''
+    Parse an HTML fragment, returning the element wrapping it.
+    '''
+    backend = backend or _default_backend
+    if backend != 'html5lib':
+        from lxml.html import fragment_fromstring
+        try:
+            return fragment_fromstring(markup, create_parent='div')
+        except Exception:
+            pass
+    import html5lib
+    return html5lib.parseFragment('<div>%s</div>' % markup, treebuilder='lxml',
+                                  namespaceHTMLElements=False)[0]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import traceback
+from threading import Thread, RLock
+from Queue import Queue
+
+DEFAULT_POOL_SIZE = 4
+
+
+class PoolThread(Thread):
+
+    def __init__(self, pool, browser):
+        Thread.__init__(self, name='DangDangFetch')
+        self.daemon = True
+        self.pool = pool
+        # Each thread owns one browser for its whole lifetime so that
+        # connections and cookies are reused between jobs
+        self.browser = browser.clone_browser()
+
+    def run(self):
+        while True:
+            job = self.pool.tasks.get()
+            if job is None:
+                break
+            func, done = job
+            try:
+                func(self.browser)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if done is not None:
+                    done.put(func)
+
+
+class FetchPool(object):
+
+    '''
+    A fixed size pool of fetch threads shared by all identify and cover
+    jobs in the process. Jobs are callables that are passed the browser of
+    the thread running them; completion is signalled by putting the job on
+    the done queue given to :meth:`submit`.
+    '''
+
+    def __init__(self, browser, size=DEFAULT_POOL_SIZE):
+        self.browser = browser
+        self.tasks = Queue()
+        self.lock = RLock()
+        self.size = 0
+        self.resize(size)
+
+    def resize(self, size):
+        size = max(1, int(size))
+        with self.lock:
+            for i in xrange(size - self.size):
+                PoolThread(self, self.browser).start()
+            # Surplus threads exit once they have finished their current job
+            for i in xrange(self.size - size):
+                self.tasks.put(None)
+            self.size = size
+
+    def submit(self, func, done=None):
+        self.tasks.put((func, done))
+
+    def shutdown(self):
+        with self.lock:
+            for i in xrange(self.size):
+                self.tasks.put(None)
+            self.size = 0
+
+
+_fetch_pool = None
+_fetch_pool_lock = RLock()
+
+
+def get_fetch_pool(browser, size=None):
+    '''
+    Return the process wide FetchPool, creating it on first use with clones
+    of browser.
+    '''
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            _fetch_pool = FetchPool(browser, size or DEFAULT_POOL_SIZE)
+        elif size and size != _fetch_pool.size:
+            _fetch_pool.resize(size)
+        return _fetch_pool
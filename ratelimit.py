@@ -0,0 +1,167 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time, random, socket
+from threading import RLock
+from urlparse import urlsplit
+
+INITIAL_RATE = 2.0
+MIN_RATE = 0.2
+MAX_RATE = 4.0
+BURST = 4
+RATE_STEP = 0.25
+BACKOFF_START = 2.0
+BACKOFF_MAX = 60.0
+
+
+class HostLimiter(object):
+
+    '''
+    Token bucket for a single host. The refill rate grows additively after
+    successful requests and is halved on failures (captcha pages, server
+    errors, timeouts), which also block the host for an exponentially
+    growing, jittered period. clock and sleep default to time.time and
+    time.sleep.
+    '''
+
+    def __init__(self, max_rate=MAX_RATE, clock=time.time, sleep=time.sleep):
+        self.lock = RLock()
+        self.clock, self.sleep = clock, sleep
+        self.max_rate = max_rate
+        self.rate = min(INITIAL_RATE, max_rate)
+        self.tokens = float(BURST)
+        self.last = clock()
+        self.blocked_until = 0
+        self.backoff = BACKOFF_START
+
+    def refill(self, now):
+        self.tokens = min(BURST, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            self.sleep(min(wait, 1))
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_STEP)
+            self.backoff = BACKOFF_START
+
+    def failure(self):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = 0
+            self.blocked_until = self.clock() + self.backoff * random.uniform(0.5, 1.5)
+            self.backoff = min(BACKOFF_MAX, self.backoff * 2)
+
+
+class RateLimiter(object):
+
+    def __init__(self, max_rate=MAX_RATE, clock=time.time, sleep=time.sleep):
+        self.lock = RLock()
+        self.clock, self.sleep = clock, sleep
+        self.max_rate = max_rate
+        self.hosts = {}
+
+    def set_max_rate(self, max_rate):
+        with self.lock:
+            self.max_rate = max_rate
+            for h in self.hosts.itervalues():
+                with h.lock:
+                    h.max_rate = max_rate
+                    h.rate = min(h.rate, max_rate)
+
+    def host(self, url):
+        key = urlsplit(url).netloc.lower()
+        with self.lock:
+            ans = self.hosts.get(key)
+            if ans is None:
+                ans = self.hosts[key] = HostLimiter(self.max_rate, self.clock, self.sleep)
+            return ans
+
+    def acquire(self, url):
+        self.host(url).acquire()
+
+    def success(self, url):
+        self.host(url).success()
+
+    def failure(self, url):
+        self.host(url).failure()
+
+
+def is_throttling_error(e):
+    '''
+    True if the exception e means the server is overloaded or refusing us,
+    as opposed to a request that is simply wrong (404, etc.)
+    '''
+    code = e.getcode() if callable(getattr(e, 'getcode', None)) else None
+    if code is not None:
+        return code >= 500 or code == 429
+    if isinstance(e, socket.timeout):
+        return True
+    attr = getattr(e, 'args', None) or [None]
+    return isinstance(attr[0], socket.timeout)
+
+
+class RateLimitedBrowser(object):
+
+    '''
+    Wraps a browser so that every request goes through the rate limiter and
+    reports its outcome to it.
+    '''
+
+    def __init__(self, browser, limiter):
+        self.browser, self.limiter = browser, limiter
+
+    def clone_browser(self):
+        return RateLimitedBrowser(self.browser.clone_browser(), self.limiter)
+
+    def open_novisit(self, url_or_request, timeout=30):
+        url = url_or_request if isinstance(url_or_request, basestring) else \
+            url_or_request.get_full_url()
+        from calibre_plugins.DANGDANG import timing
+        with timing.span('throttle'):
+            self.limiter.acquire(url)
+        try:
+            # Sending the request and reading the response, or as much of
+            # it as the browser reads before returning
+            with timing.span('fetch'):
+                ans = self.browser.open_novisit(url_or_request, timeout=timeout)
+        except Exception as e:
+            if is_throttling_error(e):
+                timing.incr('throttling_errors')
+                self.limiter.failure(url)
+            raise
+        self.limiter.success(url)
+        return ans
+
+
+_rate_limiter = None
+_rate_limiter_lock = RLock()
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
+
+
+def rate_limited(browser):
+    if isinstance(browser, RateLimitedBrowser):
+        return browser
+    return RateLimitedBrowser(browser, get_rate_limiter())
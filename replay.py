@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Record and replay of dangdang.com pages. A corpus is a directory holding
+the raw bytes of every recorded page plus an index.json mapping
+normalized URLs to file names. :class:`ReplayBrowser` serves a corpus in
+place of the calibre browser so that the whole pipeline can be run and
+benchmarked offline.
+'''
+
+import os, json, hashlib, urllib2
+from threading import RLock
+from StringIO import StringIO
+
+from calibre_plugins.DANGDANG.cache import normalize_url
+
+INDEX = 'index.json'
+
+
+class Corpus(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        try:
+            with open(os.path.join(path, INDEX), 'rb') as f:
+                self.index = json.loads(f.read())
+        except EnvironmentError:
+            self.index = {}
+
+    def save_index(self):
+        with open(os.path.join(self.path, INDEX), 'wb') as f:
+            f.write(json.dumps(self.index, indent=2, sort_keys=True).encode('utf-8'))
+
+    def add(self, url, raw):
+        key = normalize_url(url)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.html'
+        with self.lock:
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(raw)
+            self.index[key] = name
+            self.save_index()
+
+    def get(self, url):
+        name = self.index.get(normalize_url(url))
+        if name is None:
+            return None
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return f.read()
+
+    def urls(self, kind=None):
+        '''
+        Recorded URLs, optionally only those of search ('search'), details
+        ('details') or mobile details ('mobile') pages.
+        '''
+        for url in sorted(self.index):
+            if kind == 'search' and '//search.' not in url:
+                continue
+            if kind == 'details' and '//product.dangdang.' not in url:
+                continue
+            if kind == 'mobile' and '//product.m.' not in url:
+                continue
+            yield url
+
+
+class Response(object):
+
+    def __init__(self, url, raw):
+        self.url, self.fp = url, StringIO(raw)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def info(self):
+        return {}
+
+    def getcode(self):
+        return 200
+
+    def geturl(self):
+        return self.url
+
+
+class ReplayBrowser(object):
+
+    '''
+    Stand-in for the calibre browser serving pages from a corpus. Unknown
+    URLs get a 404. Pages fetched through it bypass the page cache and the
+    rate limiter.
+    '''
+
+    offline = True
+
+    def __init__(self, corpus):
+        self.corpus = corpus if isinstance(corpus, Corpus) else Corpus(corpus)
+
+    def clone_browser(self):
+        return self
+
+    def open_novisit(self, url_or_request, timeout=30):
+        url = url_or_request if isinstance(url_or_request, basestring) else \
+            url_or_request.get_full_url()
+        raw = self.corpus.get(url)
+        if raw is None:
+            raise urllib2.HTTPError(url, 404, 'Not recorded', {}, StringIO(b''))
+        return Response(url, raw)
+
+
+active_recorder = None
+
+
+def start_recording(path):
+    '''
+    Save every page downloaded by the plugin, including those served from
+    the page cache, into the corpus at path.
+    '''
+    global active_recorder
+    active_recorder = Corpus(path)
+    return active_recorder
+
+
+def stop_recording():
+    global active_recorder
+    active_recorder = None
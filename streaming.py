@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Incremental decoding and parsing of details pages. The page is decoded
+and fed to lxml as it is read, and reading stops as soon as every block
+that Worker.parse_details looks at has been closed, so the reviews,
+recommendations and footer scripts after them are never downloaded or
+parsed.
+'''
+
+import codecs
+
+CHUNK_SIZE = 16 * 1024
+
+enabled = False
+
+
+def set_enabled(val):
+    global enabled
+    enabled = bool(val)
+
+
+def block(elem):
+    '''
+    Return the name of the details page block elem is, if it is one of
+    those used for extraction.
+    '''
+    tag = elem.tag
+    if tag == 'img':
+        return 'cover' if elem.get('id') == 'largePic' else None
+    cls = elem.get('class')
+    if cls in ('messbox_info', 'book_messbox'):
+        return 'info'
+    if tag != 'div':
+        return None
+    if cls == 'name_info':
+        return 'title'
+    if cls == 'breadcrumb':
+        return 'tags'
+    if cls == 'descrip':
+        return 'comments'
+    if elem.get('id') == 'detail_describe':
+        return 'desc'
+
+REQUIRED_BLOCKS = frozenset(('title', 'cover', 'info', 'tags', 'comments', 'desc'))
+
+
+class DetailsStream(object):
+
+    def __init__(self):
+        from lxml.etree import HTMLPullParser
+        self.decoder = codecs.getincrementaldecoder('gb18030')('replace')
+        self.parser = HTMLPullParser(events=('end',))
+        self.chunks = []
+        self.seen = set()
+        self.complete = False
+
+    def feed(self, data):
+        '''
+        Feed raw bytes, returns True once all required blocks have been
+        parsed.
+        '''
+        from calibre_plugins.DANGDANG.timing import span
+        with span('decode'):
+            text = self.decoder.decode(data)
+        if text:
+            self.chunks.append(text)
+            with span('parse'):
+                self.parser.feed(text)
+                for event, elem in self.parser.read_events():
+                    name = block(elem)
+                    if name is not None:
+                        self.seen.add(name)
+            self.complete = self.seen >= REQUIRED_BLOCKS
+        return self.complete
+
+    def close(self):
+        '''
+        Return (text, root): the decoded text read so far and the parsed
+        tree.
+        '''
+        text = self.decoder.decode(b'', final=True)
+        if text:
+            self.chunks.append(text)
+            self.parser.feed(text)
+        root = self.parser.close()
+        return ''.join(self.chunks), root
+
+
+def read_details(url, timeout, browser):
+    '''
+    Read and parse the details page at url incrementally, through the page
+    cache and rate limiter. Returns (text, root, complete) where complete
+    is False if the page did not contain every required block (in which
+    case it was read in full).
+    '''
+    from calibre_plugins.DANGDANG.cache import get_http_cache
+    from calibre_plugins.DANGDANG.ratelimit import rate_limited
+    from calibre_plugins.DANGDANG import replay
+    stream = DetailsStream()
+    raw = get_http_cache().fetch_stream(rate_limited(browser), url, timeout,
+                                        stream.feed, CHUNK_SIZE)
+    if replay.active_recorder is not None:
+        replay.active_recorder.add(url, raw)
+    text, root = stream.close()
+    return text, root, stream.complete
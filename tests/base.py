@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, sys, imp, types, shutil, tempfile, unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+
+
+def load_plugin():
+    '''
+    Import the plugin from this source tree as calibre_plugins.DANGDANG,
+    unless it is already imported, for example from the installed plugin.
+    '''
+    ans = sys.modules.get('calibre_plugins.DANGDANG')
+    if ans is None:
+        if 'calibre_plugins' not in sys.modules:
+            pkg = types.ModuleType(b'calibre_plugins')
+            pkg.__path__ = []
+            sys.modules['calibre_plugins'] = pkg
+        ans = imp.load_module('calibre_plugins.DANGDANG', None, os.path.dirname(HERE),
+                              ('', '', imp.PKG_DIRECTORY))
+        # So that import calibre_plugins.DANGDANG as x works too
+        setattr(sys.modules['calibre_plugins'], 'DANGDANG', ans)
+    return ans
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def search_page(items):
+    '''
+    A search results page listing items, (dang_id, title, author) tuples.
+    '''
+    lis = ''.join(
+        '<li class="line%d"><a href="http://product.dangdang.com/%s.html" name="itemlist-picture" title="%s"></a>'
+        '<p class="name"><a name="itemlist-title" title="%s">%s</a></p>'
+        '<p class="search_book_author"><span><a name="itemlist-author" title="%s">%s</a></span>'
+        '</p></li>' % (i, dang_id, title, title, title, author, author)
+        for i, (dang_id, title, author) in enumerate(items, 1))
+    return ('<html><head><title>search</title></head><body><ul class="bigimg">%s</ul>'
+            '</body></html>' % lis).encode('gb18030')
+
+
+class Log(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, *args, **kwargs):
+        self.messages.append(args)
+    debug = info = warning = warn = error = exception = __call__
+
+
+class Response(object):
+
+    def __init__(self, body):
+        from io import BytesIO
+        self.stream = BytesIO(body)
+
+    def read(self, *args):
+        return self.stream.read(*args)
+
+    def info(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class Browser(object):
+
+    '''
+    Serve pages, a callable returning the body for a URL or None for a
+    404, and keep the URLs opened.
+    '''
+
+    def __init__(self, pages):
+        self.pages, self.opened = pages, []
+
+    def clone_browser(self):
+        return self
+
+    def open_novisit(self, url, timeout=None):
+        import urllib2
+        from io import BytesIO
+        if not isinstance(url, basestring):
+            url = url.get_full_url()
+        self.opened.append(url)
+        body = self.pages(url)
+        if body is None:
+            raise urllib2.HTTPError(url, 404, 'Not Found', {}, BytesIO(b''))
+        return Response(body)
+
+
+class PluginTestCase(unittest.TestCase):
+
+    '''
+    Run tests against a Dang plugin using the default settings, self.browser
+    to download pages and process wide caches kept in a temporary
+    directory.
+    '''
+
+    def pages(self, url):
+        return None
+
+    def setUp(self):
+        from calibre_plugins.DANGDANG import Dang, cache, covers, index, ratelimit, pool
+        self.tdir = tempfile.mkdtemp()
+        self.saved = (cache._http_cache, cache._identifier_store, covers._cover_cache,
+                      index._product_index, ratelimit._rate_limiter, pool._fetch_pool)
+        # A fresh fetch pool, using self.browser
+        pool._fetch_pool = None
+        # A fresh rate limiter, not slowed down by the CAPTCHAs of other tests
+        ratelimit._rate_limiter = ratelimit.RateLimiter()
+        cache._http_cache = cache.HttpCache(self.tdir)
+        cache._identifier_store = cache.IdentifierStore(
+            os.path.join(self.tdir, 'identifiers.sqlite'))
+        covers._cover_cache = covers.CoverCache(self.tdir)
+        index._product_index = index.ProductIndex(os.path.join(self.tdir, 'products.sqlite'))
+        self.browser = Browser(self.pages)
+        self.plugin = Dang(None)
+        self.plugin._browser = self.browser
+        # Never read or write the settings of the installed plugin
+        self.plugin._config_obj = {opt.name: opt.default for opt in self.plugin.options}
+        self.plugin.prefs['max_rate'] = 1000
+        self.log = Log()
+
+    def tearDown(self):
+        from calibre_plugins.DANGDANG import cache, covers, index, ratelimit, pool
+        if pool._fetch_pool is not None:
+            pool._fetch_pool.shutdown()
+        for conn in (cache._http_cache.conn, cache._identifier_store._conn,
+                     covers._cover_cache.conn, index._product_index._conn):
+            if conn is not None:
+                conn.close()
+        (cache._http_cache, cache._identifier_store, covers._cover_cache,
+         index._product_index, ratelimit._rate_limiter, pool._fetch_pool) = self.saved
+        shutil.rmtree(self.tdir)
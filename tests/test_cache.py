@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import load_plugin
+
+load_plugin()
+
+
+class NormalizeURLTest(unittest.TestCase):
+
+    def test_encoded_search_url(self):
+        from calibre_plugins.DANGDANG.cache import normalize_url
+        # key1=活着, key2=余华 percent encoded in gb18030
+        url = ('http://search.dangdang.com/?key1=%BB%EE%D7%C5&key2=%D3%E0%BB%AA'
+               '&medium=01&category_path=01.00.00.00.00.00')
+        self.assertEqual(normalize_url(url),
+                         'http://search.dangdang.com/?category_path=01.00.00.00.00.00'
+                         '&key1=%BB%EE%D7%C5&key2=%D3%E0%BB%AA&medium=01')
+        self.assertEqual(normalize_url(url), normalize_url(url.encode('ascii')))
+
+    def test_parameter_order(self):
+        from calibre_plugins.DANGDANG.cache import normalize_url
+        a = 'http://search.dangdang.com/?key4=9787506365437&medium=01&sort_type=sort_score_desc'
+        b = 'http://search.dangdang.com/?sort_type=sort_score_desc&key4=9787506365437&medium=01'
+        self.assertEqual(normalize_url(a), normalize_url(b))
+        self.assertNotEqual(normalize_url(a), normalize_url(a.replace('01', '02')))
+
+    def test_trivial_differences(self):
+        from calibre_plugins.DANGDANG.cache import normalize_url
+        self.assertEqual(normalize_url('HTTP://Product.DangDang.com:80//1001.html#x'),
+                         'http://product.dangdang.com/1001.html')
+
+
+class Response(object):
+
+    def __init__(self, body):
+        from io import BytesIO
+        self.stream = BytesIO(body)
+
+    def read(self, *args):
+        return self.stream.read(*args)
+
+    def info(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class Browser(object):
+
+    def __init__(self, body):
+        self.body, self.opened = body, 0
+
+    def open_novisit(self, url, timeout=None):
+        self.opened += 1
+        return Response(self.body)
+
+
+class StreamingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from calibre_plugins.DANGDANG.cache import HttpCache
+        self.tdir = tempfile.mkdtemp()
+        self.cache = HttpCache(self.tdir)
+        text = '<html><head><title>活着</title></head><body>%s</body></html>' % (
+            '<p>余华 著</p>' * 20000)
+        self.body = text.encode('gb18030')
+        self.url = 'http://product.dangdang.com/1003.html'
+
+    def tearDown(self):
+        import shutil
+        self.cache.conn.close()
+        shutil.rmtree(self.tdir)
+
+    def test_stream_then_fetch(self):
+        br = Browser(self.body)
+        raw = self.cache.fetch_stream(br, self.url, 30, lambda data: True, 16 * 1024)
+        self.assertEqual(len(raw), 16 * 1024)
+        self.assertIsNone(self.cache.lookup(self.url))
+        raw = self.cache.fetch(br, self.url, 30)
+        self.assertEqual(raw, self.body)
+        raw.decode('gb18030')
+        self.assertEqual(br.opened, 2)
+
+    def test_complete_stream_is_cached(self):
+        br = Browser(self.body)
+        raw = self.cache.fetch_stream(br, self.url, 30, lambda data: False, 16 * 1024)
+        self.assertEqual(raw, self.body)
+        self.assertEqual(self.cache.fetch(br, self.url, 30), self.body)
+        self.assertEqual(br.opened, 1)
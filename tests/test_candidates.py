@@ -0,0 +1,97 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from threading import Event
+from Queue import Queue
+
+from base import load_plugin, fixture, search_page, PluginTestCase
+
+load_plugin()
+
+
+def candidate(rank, title, authors, publisher=None, pubdate=None, cover_url=None):
+    from calibre_plugins.DANGDANG.candidates import Candidate
+    return Candidate('http://product.dangdang.com/%d.html' % (1000 + rank), rank, title,
+                     authors, publisher, pubdate, cover_url, None, None)
+
+
+class RankTest(unittest.TestCase):
+
+    def test_isbn_search(self):
+        from calibre_plugins.DANGDANG.candidates import rank, MAX_ISBN_CANDIDATES
+        cs = [candidate(i, '活着 %d' % i, ['余华']) for i in xrange(MAX_ISBN_CANDIDATES + 2)]
+        ranked = rank(cs, isbn='9787506365437')
+        self.assertEqual([c.rank for c in ranked], range(MAX_ISBN_CANDIDATES))
+        self.assertEqual({c.isbn for c in ranked}, {'9787506365437'})
+
+    def test_isbn_search_editions(self):
+        from calibre_plugins.DANGDANG.candidates import rank
+        # Listings that look alike may be different printings, only their
+        # details pages tell
+        cs = [candidate(0, '活着', ['余华'], '作家出版社'),
+              candidate(1, '活着', ['余华'], '作家出版社', '2012-08-01', 'http://img/1.jpg'),
+              candidate(2, '活着 [audiobook]', ['余华'])]
+        self.assertEqual([c.rank for c in rank(cs, isbn='9787506365437')], [0, 1])
+
+    def test_title_search(self):
+        from calibre_plugins.DANGDANG.candidates import rank, confident
+        cs = [candidate(0, '三体II 黑暗森林', ['刘慈欣']),
+              candidate(1, '三体', ['刘慈欣']),
+              candidate(2, '活着', ['余华'])]
+        ranked = rank(cs, ['三体'], ['刘慈欣'])
+        self.assertEqual([c.rank for c in ranked], [0, 1])
+        self.assertTrue(confident(ranked))
+        # The best result is kept, even if it scores badly
+        self.assertEqual([c.rank for c in rank(cs, ['球状闪电'], ['某人'])], [0])
+
+    def test_unscored(self):
+        from calibre_plugins.DANGDANG.candidates import rank
+        cs = [candidate(0, None, None), candidate(1, None, None)]
+        self.assertEqual([c.rank for c in rank(cs, ['三体'], ['刘慈欣'])], [0, 1])
+
+    def test_dedupe(self):
+        from calibre_plugins.DANGDANG.candidates import dedupe
+        cs = [candidate(0, '三体', ['刘慈欣'], '重庆出版社'),
+              candidate(1, '三体：', ['刘慈欣'], '重庆出版社', cover_url='http://img/1.jpg'),
+              candidate(2, '三体', ['刘慈欣'], '科幻世界'),
+              candidate(3, None, None)]
+        self.assertEqual([c.rank for c in dedupe(cs)], [1, 2, 3])
+
+    def test_isbn_matches(self):
+        from calibre_plugins.DANGDANG.candidates import isbn_matches
+        self.assertTrue(isbn_matches('9787506365437', '978-7-5063-6543-7'))
+        self.assertTrue(isbn_matches('7506365437', '9787506365437'))
+        self.assertFalse(isbn_matches('9787506365437', '9787020024759'))
+        self.assertTrue(isbn_matches(None, '9787020024759'))
+        self.assertTrue(isbn_matches('9787506365437', None))
+
+
+class ISBNSearchTest(PluginTestCase):
+
+    def pages(self, url):
+        if url.startswith('http://search.dangdang.com/'):
+            # The ISBN search also finds the other edition
+            return search_page([('1004', '活着', '余华'), ('1003', '活着', '余华')])
+        if url == 'http://product.dangdang.com/1003.html':
+            return fixture('details_1003.html')
+        if url == 'http://product.dangdang.com/1004.html':
+            return fixture('details_1003.html').replace(b'1003', b'1004').replace(
+                b'9787506365437', b'9787020024759')
+
+    def test_other_edition_dropped(self):
+        self.plugin.prefs['hedged_search'] = False
+        rq = Queue()
+        self.plugin.identify(self.log, rq, Event(), title='活着', authors=['余华'],
+                             identifiers={'isbn': '9787506365437'})
+        results = []
+        while not rq.empty():
+            results.append(rq.get())
+        self.assertEqual([mi.identifiers['dang'] for mi in results], ['1003'])
+        self.assertEqual(len(self.browser.opened), 3)
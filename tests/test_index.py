@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, tempfile, unittest
+
+from base import load_plugin, PluginTestCase
+
+load_plugin()
+
+
+class ProductIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        from calibre_plugins.DANGDANG.index import ProductIndex
+        self.tdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tdir, 'products.sqlite')
+        self.index = ProductIndex(self.path)
+
+    def tearDown(self):
+        self.index.conn.close()
+        shutil.rmtree(self.tdir)
+
+    def test_lookup(self):
+        self.index.add('1003', '活着', ['余华'], '9787506365437', '作家出版社',
+                       {'t:活着', 'a:余华'})
+        row = ('1003', '活着', ['余华'], '9787506365437', '作家出版社')
+        self.assertEqual(self.index.lookup({'t:活着', 'a:余华'}), [row])
+        self.assertEqual(self.index.lookup({'t:活着', 'a:莫言'}), [])
+        self.assertEqual(self.index.lookup_isbn('9787506365437'), [row])
+        self.assertEqual(len(self.index), 1)
+
+    def test_authors_with_separator(self):
+        authors = ['Tom & Jerry', 'Someone']
+        self.index.add('1', 'Title', authors, None, None, {'t:title'})
+        self.assertEqual(self.index.lookup({'t:title'})[0][2], authors)
+
+    def test_merge(self):
+        self.index.add('1003', '活着', ['余华'], '9787506365437', '作家出版社',
+                       {'t:活着', 'a:余华'})
+        # Parsed again with only some of the fields
+        self.index.add('1003', '活着', ['余华'], None, None, {'t:活着', 'a:余华'})
+        self.assertEqual(self.index.lookup_isbn('9787506365437'),
+                         [('1003', '活着', ['余华'], '9787506365437', '作家出版社')])
+        self.index.add('1003', '活着', ['余华'], None, '北京十月文艺出版社',
+                       {'t:活着', 'a:余华'})
+        self.assertEqual(self.index.lookup({'t:活着'})[0][3:],
+                         ('9787506365437', '北京十月文艺出版社'))
+
+
+class LocalCandidatesTest(PluginTestCase):
+
+    def add(self, dang_id, title, authors):
+        from calibre.ebooks.metadata.book.base import Metadata
+        mi = Metadata(title, authors)
+        mi.identifiers = {'dang': dang_id}
+        self.plugin.add_to_index(mi)
+
+    def local_ids(self, title, authors):
+        return [c.url for c in self.plugin.local_candidates(self.log, title, authors)]
+
+    def test_exact_title(self):
+        self.add('1001', '三体', ['刘慈欣'])
+        self.add('1002', '三体 II', ['刘慈欣'])
+        self.assertEqual(self.local_ids('三体', ['刘慈欣']),
+                         ['http://product.dangdang.com/1001.html'])
+        self.assertEqual(self.local_ids('三体 II', ['刘慈欣', '某人']),
+                         ['http://product.dangdang.com/1002.html'])
+        self.assertEqual(self.local_ids('三体', ['某人']), [])
+
+    def test_later_volume_only(self):
+        # Only a book whose title contains the query title is known, search
+        self.add('1002', '三体 II', ['刘慈欣'])
+        self.assertEqual(self.local_ids('三体', ['刘慈欣']), [])
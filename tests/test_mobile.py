@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import load_plugin, fixture
+
+load_plugin()
+
+FIELDS = frozenset(('comments', 'series', 'tags', 'cover', 'isbn', 'publisher', 'pubdate'))
+
+
+class MobileTest(unittest.TestCase):
+
+    def test_mobile_url(self):
+        from calibre_plugins.DANGDANG.mobile import mobile_url
+        self.assertEqual(mobile_url('1001'), 'http://product.m.dangdang.com/1001.html')
+
+    def test_head_meta(self):
+        from calibre_plugins.DANGDANG.mobile import head_meta
+        meta = head_meta(fixture('mobile_1001.html'))
+        # The <meta> tag in the body is not read
+        self.assertEqual(meta['og:title'], ['三体'])
+        self.assertEqual(meta['book:isbn'], ['9787536692930'])
+        # Declared with http-equiv, not <meta charset>
+        meta = head_meta(fixture('mobile_1003.html'))
+        self.assertEqual(meta['og:title'], ['活着'])
+        self.assertEqual(meta['book:author'], ['余华'])
+
+    def test_parse_record(self):
+        from calibre_plugins.DANGDANG.mobile import parse_record
+        record = parse_record(fixture('mobile_1001.html'), '1001', FIELDS)
+        self.assertEqual(record['title'], '三体')
+        self.assertEqual(record['authors'], ['刘慈欣', 'Ken Liu'])
+        self.assertEqual(record['dang_id'], '1001')
+        self.assertEqual(record['isbn'], '9787536692930')
+        self.assertEqual(record['cover_url'], 'http://img3m0.ddimg.cn/4/24/1001-1_w_1.jpg')
+        self.assertTrue(record['comments'].startswith('<p>文化大革命'))
+        self.assertEqual(record['pubdate'].year, 2008)
+        for field in ('tags', 'series', 'publisher'):
+            self.assertNotIn(field, record)
+
+    def test_restricted_fields(self):
+        from calibre_plugins.DANGDANG.mobile import parse_record
+        record = parse_record(fixture('mobile_1001.html'), '1001', frozenset(('tags',)))
+        self.assertEqual(sorted(record), ['authors', 'dang_id', 'title'])
+
+    def test_missing_isbn(self):
+        from calibre_plugins.DANGDANG.mobile import parse_record
+        raw = fixture('mobile_1003.html')
+        # Only extracted for the caches, the page is still used
+        record = parse_record(raw, '1003', FIELDS)
+        self.assertEqual(record['title'], '活着')
+        self.assertNotIn('isbn', record)
+        self.assertEqual(record['comments'], '<p>《活着》讲述了农村人福贵悲惨的人生遭遇。</p>')
+        # Asked for, the desktop page has to be used
+        self.assertIsNone(parse_record(raw, '1003', FIELDS, frozenset(('isbn',))))
+
+    def test_unusable_page(self):
+        from calibre_plugins.DANGDANG.mobile import parse_record
+        raw = fixture('mobile_1003.html').replace(b'book:author', b'book:translator')
+        self.assertIsNone(parse_record(raw, '1003', FIELDS))
+        self.assertIsNone(parse_record(fixture('details_1003.html'), '1003', FIELDS))
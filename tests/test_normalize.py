@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import load_plugin
+
+load_plugin()
+
+# (input, expected output) pairs, also timed by the normalize command of
+# benchmark.py
+COMMENTS = [
+    ('<p class="x" id="y">内容简介</p>\n\n\n<div  style="a">一本   好书</div>',
+     '<p>内容简介</p>\n<div>一本 好书</div>'),
+    ('Text <!-- a\n\n comment --> more  text\n\n<em>--This text refers to an out of print edition.</em>',
+     'Text  more text\n'),
+    ('<em class="n">--This text refers to\n another  edition</em>\ufffds', "'s"),
+    ('<!-- <a href="x">link</a> -->   \n \n\n<b >bold</b>', ' \n \n<b >bold</b>'),
+]
+DATES = [
+    ('出版时间:2015年3月', '2015/3/1'),
+    ('出版时间:2008-01-01', '2008/01/01'),
+    ('2015年3月1日', '2015/3/1'),
+    (' 出版时间:2016年9月 ', '2016/9/1'),
+    ('2012-11', '2012/11'),
+    ('出版时间:2019年12月1日', '2019/12/1'),
+]
+TITLES = [
+    (('The Blood of Olympus: Book 5 of Heroes of Olympus', 'Heroes of Olympus'),
+     'The Blood of Olympus'),
+    (('Three Parts Dead (Craft Sequence)', 'craft sequence'), 'Three Parts Dead'),
+    (('Throne: The Crescent Moon Book 1', 'The Crescent Moon'), 'Throne'),
+    (('三体', '地球往事'), '三体'),
+    # Nothing would be left
+    (('(Series)', 'Series'), '(Series)'),
+    (('A (b.c) Book 2', 'b.c'), 'A (b.c) Book 2'),
+]
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_clean_comments(self):
+        from calibre_plugins.DANGDANG.normalize import clean_comments
+        for raw, expected in COMMENTS:
+            self.assertEqual(clean_comments(raw), expected, raw)
+
+    def test_comments_pat(self):
+        from calibre_plugins.DANGDANG.normalize import comments_pat
+        self.assertEqual([m.lastgroup for m in comments_pat.finditer(
+            '<!-- x --><p class="a">\n\n  </p>')], ['drop', 'tag', 'nl', 'sp'])
+        self.assertEqual(comments_pat.sub('', '<p>a\nb c</p>'), '<p>a\nb c</p>')
+
+    def test_pubdate_text(self):
+        from calibre_plugins.DANGDANG.normalize import pubdate_text
+        for raw, expected in DATES:
+            self.assertEqual(pubdate_text(raw), expected, raw)
+
+    def test_delocalize_datestr(self):
+        from calibre_plugins.DANGDANG.normalize import delocalize_datestr
+        self.assertEqual(delocalize_datestr('2015年3月'), '2015年Mar')
+        self.assertEqual(delocalize_datestr('2015年12月1日'), '2015年Dec1日')
+        self.assertEqual(delocalize_datestr('12月 de 2015'), 'Dec 2015')
+        self.assertEqual(delocalize_datestr('MAR 2015'), 'mar 2015')
+
+    def test_strip_series_from_title(self):
+        from calibre_plugins.DANGDANG.normalize import strip_series_from_title
+        for args, expected in TITLES:
+            self.assertEqual(strip_series_from_title(*args), expected, args)
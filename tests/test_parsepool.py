@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest, cPickle
+from threading import Thread
+
+from base import load_plugin, fixture, Log
+
+load_plugin()
+
+URL = 'http://product.dangdang.com/1003.html'
+FIELDS = frozenset(('comments', 'series', 'tags', 'cover', 'isbn', 'publisher', 'pubdate'))
+
+
+def extract_in_thread(raw):
+    import calibre_plugins.DANGDANG as dd
+    log = Log()
+    w = dd.Worker(URL, None, None, log, 0, None, fields=FIELDS)
+    return w.extract_fields(*dd.parse_details_raw(raw, URL, log))
+
+
+class ParsePoolTest(unittest.TestCase):
+
+    def test_extract_record(self):
+        from calibre_plugins.DANGDANG.parsepool import extract_record
+        raw = fixture('details_1003.html')
+        status, record, messages, timings = cPickle.loads(cPickle.dumps(
+            extract_record(raw, URL, FIELDS, 'auto'), -1))
+        self.assertEqual(status, 'ok')
+        self.assertEqual(record, extract_in_thread(raw))
+        self.assertEqual(record['isbn'], '9787506365437')
+        self.assertEqual(record['authors'], ['余华'])
+        self.assertIn('extract_title', timings[0])
+
+    def test_pool(self):
+        from calibre_plugins.DANGDANG.parsepool import ParsePool
+        raw = fixture('details_1003.html')
+        expected = extract_in_thread(raw)
+        try:
+            from calibre.utils.ipc.simple_worker import offload_worker  # noqa
+        except ImportError:
+            self.skipTest('calibre worker processes are not available')
+        from calibre.customize.ui import find_plugin
+        if find_plugin('DangDang') is None:
+            self.skipTest('The plugin must be installed for parse processes to load it')
+        pool = ParsePool(2)
+        try:
+            results = []
+
+            def run():
+                results.append(pool.extract(raw, URL, FIELDS, Log()))
+            threads = [Thread(target=run) for i in xrange(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(results, [expected] * 4)
+            self.assertEqual(len(pool.workers), 2)
+        finally:
+            pool.shutdown()
+
+    def test_disabled(self):
+        from calibre_plugins.DANGDANG.parsepool import get_parse_pool
+        self.assertIsNone(get_parse_pool(0))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import socket, unittest, urllib2
+from io import BytesIO
+
+from base import load_plugin
+
+load_plugin()
+
+URL = 'http://product.dangdang.com/1003.html'
+
+
+class Clock(object):
+
+    '''
+    A clock that only moves when slept on.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        from calibre_plugins.DANGDANG.ratelimit import RateLimiter
+        self.clock = Clock()
+        self.limiter = RateLimiter(clock=self.clock, sleep=self.clock.sleep)
+
+    def acquire(self, n=1):
+        start = self.clock.now
+        for i in xrange(n):
+            self.limiter.acquire(URL)
+        return self.clock.now - start
+
+    def test_burst_and_refill(self):
+        from calibre_plugins.DANGDANG.ratelimit import BURST, INITIAL_RATE
+        self.assertEqual(self.acquire(BURST), 0)
+        self.assertAlmostEqual(self.acquire(), 1 / INITIAL_RATE)
+        # Idle time refills the bucket, up to BURST tokens
+        self.clock.now += 100
+        self.assertEqual(self.acquire(BURST), 0)
+        self.assertGreater(self.acquire(), 0)
+
+    def test_hosts(self):
+        from calibre_plugins.DANGDANG.ratelimit import BURST
+        self.acquire(BURST)
+        self.limiter.acquire('http://img3m9.ddimg.cn/1003.jpg')
+        self.assertEqual(self.clock.slept, [])
+
+    def test_additive_increase(self):
+        from calibre_plugins.DANGDANG.ratelimit import INITIAL_RATE, RATE_STEP, MAX_RATE
+        host = self.limiter.host(URL)
+        self.limiter.success(URL)
+        self.assertAlmostEqual(host.rate, INITIAL_RATE + RATE_STEP)
+        for i in xrange(100):
+            self.limiter.success(URL)
+        self.assertEqual(host.rate, MAX_RATE)
+        self.limiter.set_max_rate(1)
+        self.assertEqual(host.rate, 1)
+        self.limiter.success(URL)
+        self.assertEqual(host.rate, 1)
+
+    def test_halved_on_failure(self):
+        from calibre_plugins.DANGDANG.ratelimit import INITIAL_RATE, MIN_RATE
+        host = self.limiter.host(URL)
+        self.limiter.failure(URL)
+        self.assertEqual(host.rate, INITIAL_RATE / 2)
+        self.assertEqual(host.tokens, 0)
+        for i in xrange(20):
+            self.limiter.failure(URL)
+        self.assertEqual(host.rate, MIN_RATE)
+
+    def test_backoff(self):
+        from calibre_plugins.DANGDANG.ratelimit import BACKOFF_START, BACKOFF_MAX
+        host = self.limiter.host(URL)
+        blocks = []
+        for i in xrange(8):
+            self.limiter.failure(URL)
+            blocks.append(host.blocked_until - self.clock.now)
+        backoff = BACKOFF_START
+        for block in blocks:
+            # Jittered around a backoff that doubles up to BACKOFF_MAX
+            self.assertTrue(backoff * 0.5 <= block <= backoff * 1.5, (backoff, block))
+            backoff = min(BACKOFF_MAX, backoff * 2)
+        self.assertEqual(host.backoff, BACKOFF_MAX)
+        # Requests wait for the end of the block
+        self.assertGreaterEqual(self.acquire(), blocks[-1])
+        # and a success resets the backoff
+        self.limiter.success(URL)
+        self.assertEqual(host.backoff, BACKOFF_START)
+
+    def test_jitter(self):
+        from calibre_plugins.DANGDANG.ratelimit import HostLimiter
+        blocks = set()
+        for i in xrange(10):
+            host = HostLimiter(clock=self.clock, sleep=self.clock.sleep)
+            host.failure()
+            blocks.add(host.blocked_until)
+        self.assertGreater(len(blocks), 1)
+
+
+class ThrottlingErrorTest(unittest.TestCase):
+
+    def http_error(self, code):
+        return urllib2.HTTPError(URL, code, 'Error', {}, BytesIO(b''))
+
+    def test_is_throttling_error(self):
+        from calibre_plugins.DANGDANG.ratelimit import is_throttling_error
+        for code in (500, 503, 429):
+            self.assertTrue(is_throttling_error(self.http_error(code)), code)
+        for code in (404, 403, 400):
+            self.assertFalse(is_throttling_error(self.http_error(code)), code)
+        self.assertTrue(is_throttling_error(socket.timeout('timed out')))
+        self.assertTrue(is_throttling_error(urllib2.URLError(socket.timeout('timed out'))))
+        self.assertFalse(is_throttling_error(urllib2.URLError('Name or service not known')))
+        self.assertFalse(is_throttling_error(ValueError('bad')))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+from threading import Event, Thread
+
+from base import load_plugin, fixture, search_page, PluginTestCase
+
+load_plugin()
+
+QUERY = 'http://search.dangdang.com/?key4=9787020024759&medium=01'
+NOT_FOUND = ('<html><head><title>对不起，您要访问的页面暂时没有找到</title></head>'
+             '<body></body></html>').encode('gb18030')
+CAPTCHA = ('<html><head><title>当当</title></head><body>'
+           '<form action="/errors/validateCaptcha"></form></body></html>').encode('gb18030')
+
+
+class NegativeCacheTest(PluginTestCase):
+
+    page = NOT_FOUND
+
+    def pages(self, url):
+        return self.page
+
+    def search(self):
+        return self.plugin.search_candidates(self.log, Event(), self.plugin.browser,
+                                             QUERY, 'isbn', isbn='9787020024759')
+
+    def test_not_repeated(self):
+        self.assertEqual(self.search(), [])
+        self.assertEqual(self.search(), [])
+        self.assertEqual(len(self.browser.opened), 1)
+
+    def test_repeated_after_ttl(self):
+        from calibre_plugins.DANGDANG.cache import get_identifier_store
+        self.assertEqual(self.search(), [])
+        store = get_identifier_store()
+        with store.lock:
+            store.conn.execute('UPDATE misses SET time=time-?',
+                               (self.plugin.prefs['negative_ttl'] * 3600 + 1,))
+            store.conn.commit()
+        self.assertEqual(self.search(), [])
+        self.assertEqual(len(self.browser.opened), 2)
+
+    def test_negative_cache_disabled(self):
+        self.plugin.prefs['negative_ttl'] = 0
+        self.search()
+        self.search()
+        self.assertEqual(len(self.browser.opened), 2)
+
+    def test_captcha(self):
+        from calibre_plugins.DANGDANG.cache import get_http_cache, get_identifier_store
+        self.page = CAPTCHA
+        self.assertEqual(self.search(), [])
+        self.assertIsNone(get_identifier_store().missed_query(QUERY, 3600))
+        self.assertIsNone(get_http_cache().lookup(QUERY))
+
+
+class HedgedSearchTest(PluginTestCase):
+
+    isbn_results = [('1003', '活着', '余华')]
+
+    def pages(self, url):
+        if 'key4=' in url:
+            return search_page(self.isbn_results) if self.isbn_results else None
+        if 'key1=' in url:
+            # Not a confident match, used only if the ISBN search finds nothing
+            return search_page([('1005', '许三观卖血记', '余华')])
+
+    def find(self):
+        return [c.url for c in self.plugin.find_candidates(
+            self.log, Event(), self.plugin.browser, title='活着', authors=['余华'],
+            identifiers={'isbn': '9787506365437'})]
+
+    def test_isbn_results(self):
+        self.assertEqual(self.find(), ['http://product.dangdang.com/1003.html'])
+
+    def test_title_results(self):
+        self.isbn_results = []
+        self.assertEqual(self.find(), ['http://product.dangdang.com/1005.html'])
+
+    def test_from_pool_thread(self):
+        # A search made from the only pool thread cannot wait on the pool
+        self.plugin.prefs['pool_size'] = 1
+        ans = []
+        t = Thread(target=self.plugin.run_jobs, args=(
+            [lambda browser: ans.extend(self.find())], Event()))
+        t.daemon = True
+        t.start()
+        t.join(10)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(ans, ['http://product.dangdang.com/1003.html'])
+
+
+class IdentifyManyTest(PluginTestCase):
+
+    def pages(self, url):
+        if url.startswith('http://search.dangdang.com/'):
+            return search_page([('1003', '活着', '余华')])
+        if url == 'http://product.dangdang.com/1003.html':
+            return fixture('details_1003.html')
+
+    def test_duplicate_isbns(self):
+        # One pool thread, so that the searches are run one after the other
+        self.plugin.prefs['pool_size'] = 1
+        self.plugin.prefs['hedged_search'] = False
+        queries = [('活着', ['余华'], {'isbn': '9787506365437'}),
+                   ('活着', ['余华'], {'isbn': '978-7-5063-6543-7'}),
+                   (None, None, {'isbn': '9787506365437'})]
+        results = dict(self.plugin.identify_many(self.log, Event(), queries))
+        self.assertEqual(sorted(results), [0, 1, 2])
+        for i, mis in results.iteritems():
+            self.assertEqual([(mi.identifiers['dang'], mi.isbn) for mi in mis],
+                             [('1003', '9787506365437')], i)
+        # One search and one details page for the ISBN
+        self.assertEqual(len(self.browser.opened), 2, self.browser.opened)
+        self.assertEqual(self.browser.opened[1], 'http://product.dangdang.com/1003.html')
+
+    def metadata(self, dang_id, isbn, **kw):
+        from calibre.ebooks.metadata.book.base import Metadata
+        mi = Metadata('活着', ['余华'])
+        mi.identifiers, mi.isbn = {'dang': dang_id}, isbn
+        for k, v in kw.iteritems():
+            setattr(mi, k, v)
+        return mi
+
+    def test_unique_isbns(self):
+        from Queue import Queue
+        from calibre_plugins.DANGDANG import unique_isbns, UniqueISBNQueue
+        mis = [self.metadata('1003', '9787506365437'),
+               self.metadata('1004', None),
+               # The same book sold by a seller, with a description
+               self.metadata('1005', '9787506365437', comments='一本好书'),
+               self.metadata('1006', None)]
+        self.assertEqual([mi.identifiers['dang'] for mi in unique_isbns(mis)],
+                         ['1005', '1004', '1006'])
+        q = Queue()
+        rq = UniqueISBNQueue(q, self.log)
+        for mi in mis:
+            rq.put(mi)
+        self.assertEqual([q.get_nowait().identifiers['dang'] for i in xrange(q.qsize())],
+                         ['1003', '1004', '1006'])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Timing spans and event counters for the identify pipeline. Every span and
+counter is added to the process wide :data:`totals` and to the
+:class:`Stats` being collected by the current thread, if any, so that both
+per call summaries and aggregates over a bulk run are available. Jobs run
+on the fetch pool are wrapped with :func:`bind` so that what they record is
+attributed to the call that submitted them.
+'''
+
+import json
+from threading import RLock, local
+
+try:
+    from calibre.utils.monotonic import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = RLock()
+        self.spans = {}  # name -> [count, total seconds, max seconds]
+        self.counters = {}
+
+    def add_span(self, name, elapsed):
+        with self.lock:
+            s = self.spans.get(name)
+            if s is None:
+                self.spans[name] = [1, elapsed, elapsed]
+            else:
+                s[0] += 1
+                s[1] += elapsed
+                s[2] = max(s[2], elapsed)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        with other.lock:
+            spans, counters = dict(other.spans), dict(other.counters)
+        with self.lock:
+            for name, (count, total, mx) in spans.iteritems():
+                s = self.spans.setdefault(name, [0, 0, 0])
+                s[0] += count
+                s[1] += total
+                s[2] = max(s[2], mx)
+            for name, n in counters.iteritems():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def summary(self):
+        '''
+        Return a JSON serializable dict with the count, total, mean and
+        maximum duration (in milliseconds) of every span and the value of
+        every counter.
+        '''
+        with self.lock:
+            spans = dict((name, {
+                'count': count, 'total_ms': round(1000 * total, 3),
+                'mean_ms': round(1000 * total / count, 3),
+                'max_ms': round(1000 * mx, 3)}) for name, (count, total, mx)
+                in self.spans.iteritems())
+            return {'spans': spans, 'counters': dict(self.counters)}
+
+    def to_json(self):
+        return json.dumps(self.summary(), sort_keys=True)
+
+
+totals = Stats()
+_state = local()
+
+
+def current():
+    return getattr(_state, 'stats', None)
+
+
+class collecting(object):
+
+    '''
+    Context manager collecting what is recorded by this thread, and by the
+    jobs it binds, into a new :class:`Stats` instance.
+    '''
+
+    def __init__(self, stats=None):
+        self.stats = Stats() if stats is None else stats
+
+    def __enter__(self):
+        self.previous = current()
+        _state.stats = self.stats
+        return self.stats
+
+    def __exit__(self, *args):
+        _state.stats = self.previous
+
+
+def bind(func, stats=None):
+    '''
+    Wrap func so that, whatever thread it runs on, what it records goes to
+    stats, by default the stats being collected by the calling thread.
+    '''
+    stats = current() if stats is None else stats
+    if stats is None:
+        return func
+
+    def run(*args, **kwargs):
+        with collecting(stats):
+            return func(*args, **kwargs)
+    return run
+
+
+def record(name, elapsed):
+    totals.add_span(name, elapsed)
+    stats = current()
+    if stats is not None:
+        stats.add_span(name, elapsed)
+
+
+def add(spans, counters):
+    '''
+    Add the spans and counters of a :class:`Stats` recorded elsewhere, such
+    as in a parse process.
+    '''
+    stats = Stats()
+    stats.spans, stats.counters = spans, counters
+    totals.merge(stats)
+    if current() is not None:
+        current().merge(stats)
+
+
+def incr(name, n=1):
+    totals.incr(name, n)
+    stats = current()
+    if stats is not None:
+        stats.incr(name, n)
+
+
+class span(object):
+
+    '''
+    Context manager recording the time spent in its block under name.
+    '''
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = monotonic()
+
+    def __exit__(self, *args):
+        record(self.name, monotonic() - self.start)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2016, Gordon Yau <qunxyz@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+XPath expressions used to extract fields from dangdang.com pages, compiled
+once when this module is first imported. Expressions starting with
+descendant:: are meant to be evaluated on the product info block
+(messbox_info for dangdang's own store, book_messbox for third party
+sellers) rather than on the whole document.
+'''
+
+from lxml.etree import XPath
+
+# Document level
+canonical_link = XPath('/html/head/link[@rel="canonical" and @href]')
+any_canonical_link = XPath('//link[@rel="canonical" and @href]')
+captcha_form = XPath('//form[@action="/errors/validateCaptcha"]')
+error_message = XPath('//*[@id="errorMessage"]')
+title = XPath('//div[@class="name_info"]/h1')
+large_pic = XPath('//img[@id="largePic"]')
+comments = XPath('//div[@class="descrip"]')
+tags = XPath('//div[@class="breadcrumb"]/a')
+pd_desc = XPath('//div[@id="detail_describe"]')
+pd_info = XPath('//*[@class="messbox_info"]')  # dangdang store
+pd_info_store = XPath('//*[@class="book_messbox"]')  # third party store
+series_title = XPath('//div[@data-feature-name="seriesTitle"]')
+series_ebook_spans = XPath('//div[@id="aboutEbooksSection"]//li/span')
+series_buying = XPath('//div[@id="ps-content"]/div[@class="buying"]')
+
+# Authors
+authors = XPath('//span[@id="author"]/a')
+info_authors = XPath('descendant::span[@id="author"]/a')
+store_authors = XPath('div[1]/div[2]')
+
+# Product info block
+info_publisher = XPath('descendant::span[@dd_name="出版社"]/a')
+any_publisher = XPath('//span[@dd_name="出版社"]/a')
+info_publisher_cells = XPath(
+    'descendant::div[@class="show_info_left" and contains(text(), "出") and'
+    ' contains(text(), "版") and contains(text(), "社")]/../div')
+info_pubdate = XPath('descendant::*[@dd_name="出版社"]/../span[starts-with(text(), "出版时间")]')
+info_pubdate_cells = XPath('descendant::div[@class="show_info_left" and contains(text(), "出版时间")]/../div')
+any_pubdate_cells = XPath('//div[@class="show_info_left" and contains(text(), "出版时间")]/../div')
+info_isbn_cells = XPath(
+    'descendant::div[@class="show_info_left" and (contains(text(), "I") and'
+    ' contains(text(), "S") and contains(text(), "B") and contains(text(), "N")) or ('
+    ' contains(text(), "Ｉ") and contains(text(), "Ｓ") and contains(text(), "Ｂ") and'
+    ' contains(text(), "Ｎ"))]/../div')
+desc_isbn = XPath('descendant::*[starts-with(text(), "国际标准书号ISBN")]')
+
+# Series, relative to the series containers
+series_spans = XPath('./span')
+series_link = XPath('./a[@id="series-page-link"]')
+span_links = XPath('./a[@href]')
+
+# Comments, relative to the description element
+comments_sections = XPath(
+    'descendant::*[contains(text(), "内容提要") or contains(text(), "内容推荐")'
+    ' or contains(text(), "编辑推荐") or contains(text(), "内容简介")'
+    ' or contains(text(), "基本信息")]/../*[self::p or self::div or self::span]')
+noscript = XPath('descendant::noscript')
+comments_junk = XPath('descendant::*[@class="seeAll" or @class="emptyClear"'
+                      ' or @id="collapsePS" or @id="expandPS"]')
+links = XPath('descendant::a[@href]')
+
+# Search results, item fields are relative to the result item
+result_items = XPath('//li[starts-with(@class, "line")]')
+item_link = XPath('descendant::a[@href and contains(@name, "itemlist-picture")]')
+item_title = XPath('descendant::a[@name="itemlist-title"]')
+item_authors = XPath('descendant::a[@name="itemlist-author"]')
+item_publisher = XPath('descendant::a[@name="P_cbs"]')
+item_author_line = XPath('descendant::p[@class="search_book_author"]')
+item_image = XPath('descendant::a[contains(@name, "itemlist-picture")]/img')